@@ -1,30 +1,48 @@
-from backend.general import config, end_safely, translate_locations
-from backend.api_access import get_homebox_auth_key, get_locations, add_item
-from backend.voice_recognition import interpret_sound_file
-from backend.llm import get_parsed_list
+from backend.general import config, end_safely, translate_locations, fix_locations, override_config
+from backend.api_access import (get_homebox_auth_key, get_location_tree, index_locations, add_item, get_all_items,
+                                 project_item, HomeboxAuthError)
+from backend.bulk import run_bulk
+from backend.locations import LocationIndex
+from backend.snapshot import SnapshotStore
+from backend.cache import ResultCache, make_key
+from backend.voice_recognition import interpret_sound_file, transcribe_sound_file
+from backend.llm import get_parsed_list, get_parsed_lists_batch
 from backend.error_check import check_for_errors_with_header
+from backend.csv_io import item_row, write_rows
+from backend.tracing import span, traced_run
+from backend.duplicates import NameIndex, INDEX_FIELDS, propose_merges, has_merges, merge_item
+from cli import parse_command
 
 
 import os
-import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import cache
 from dotenv import load_dotenv
-from pydantic import BaseModel
-import csv
 
 
-# Data models for Gemini return
-class Item(BaseModel):
-    name: str
-    quantity: int
-    description: str
+# Data models for Gemini return, only built once needed since pydantic is slow to import
+@cache
+def response_schema() -> type:
+    from pydantic import BaseModel
 
+    class Item(BaseModel):
+        name: str
+        quantity: int
+        description: str
 
-class Additions(BaseModel):
-    location: str
-    items: list[Item]
+    class Additions(BaseModel):
+        location: str
+        items: list[Item]
 
+    return list[Additions]
 
-def process_with_llm(recognised_text: str, location_list: list[str]) -> list[dict]:
+
+# Bump when the structuring prompt changes, so cached answers from the old prompt are not reused
+PROMPT_VERSION = 1
+
+
+def build_prompt(recognised_text: str, location_list: list[str]) -> str:
     # AI prompt to structure the recognized text properly
     prompt = f"""
                 The following is a speech-recognition text with one or more parts which each start with a location and is followed by a list of items separated by the word "next".
@@ -44,76 +62,244 @@ def process_with_llm(recognised_text: str, location_list: list[str]) -> list[dic
                 {recognised_text} 
                 """
 
-    llm_config = {
-            "response_mime_type": "application/json",
-            "response_schema": list[Additions]
-        }
+    return prompt
+
+
+def llm_config() -> dict:
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": response_schema()
+    }
+
+
+def llm_cache() -> ResultCache | None:
+    if config.getboolean("CACHE", "enabled", fallback=True) and config.getboolean("CACHE", "adder_llm", fallback=True):
+        return ResultCache("adder_llm")
+    return None
 
-    return get_parsed_list(prompt, llm_config)
 
+# Cached answers are only valid for the same transcript, location list and prompt
+def llm_cache_key(recognised_text: str, location_list: list[str]) -> str:
+    return make_key(recognised_text, make_key(location_list),
+                    config.getboolean("ADDER", "generate_description"), PROMPT_VERSION)
 
-# Add all items in a data dict to Homebox
+
+def process_with_llm(recognised_text: str, location_list: list[str]) -> list[dict]:
+    result = process_many_with_llm([recognised_text], location_list)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+# Structure several transcripts at once, answering from the cache where possible
+# A transcript that could not be structured holds the exception instead of its result
+def process_many_with_llm(texts: list[str], location_list: list[str]) -> list[list[dict] | Exception]:
+    cache = llm_cache()
+    keys = [llm_cache_key(text, location_list) for text in texts]
+    results = [cache.get(key) if cache else None for key in keys]
+
+    missing = [index for index, result in enumerate(results) if result is None]
+    if len(missing) == 1:  # No need for the async machinery
+        try:
+            results[missing[0]] = get_parsed_list(build_prompt(texts[missing[0]], location_list), llm_config())
+        except Exception as e:
+            results[missing[0]] = e
+    elif missing:
+        answers = get_parsed_lists_batch([build_prompt(texts[index], location_list) for index in missing], llm_config())
+        for index, answer in zip(missing, answers):
+            results[index] = answer
+
+    if cache:
+        cache.put_many({keys[index]: results[index] for index in missing
+                        if not isinstance(results[index], Exception)})
+        cache.close()
+    return results
+
+
+# Merge the results of several recordings, so each location only appears once
+def merge_additions(results: list[list[dict]]) -> list[dict]:
+    merged = {}
+    for additions in results:
+        for entry in additions:
+            if entry["location"] in merged:
+                merged[entry["location"]]["items"].extend(entry["items"])
+            else:
+                merged[entry["location"]] = {"location": entry["location"], "items": list(entry["items"])}
+
+    return list(merged.values())
+
+
+# Add all items in a data dict to Homebox, several at a time
 def add_data_to_storage(data: list[dict], auth_key: str) -> dict:
-    failed_adds = {}
+    tasks = []
     for container in data:
         location = container["location"]
         for item in container["items"]:
             item["locationId"] = location
-            res = add_item(item, auth_key)
-            if not res:
-                if location in failed_adds:
-                    failed_adds[location].append(item)
-                else:
-                    failed_adds[location] = [item]
+            tasks.append((location, item))
+
+    # Items with an ID were merged into an existing item during review
+    def store(task: tuple) -> bool:
+        item = task[1]
+        return merge_item(item, auth_key) if "id" in item else add_item(item, auth_key)
+
+    with span("adder add items") as current:
+        current.items = len(tasks)
+        result = run_bulk(
+            tasks,
+            store,
+            max_workers=config.getint("BULK", "max_workers", fallback=4),
+            requests_per_second=config.getfloat("BULK", "requests_per_second", fallback=0),
+            stop_on=(HomeboxAuthError,)
+        )
+    if result.error:
+        print("Homebox rejected the login, remaining items were not added.")
+
+    failed_adds = {}
+    for (location, item), res in zip(tasks, result.results):
+        if res is not True:
+            if location in failed_adds:
+                failed_adds[location].append(item)
+            else:
+                failed_adds[location] = [item]
 
     return failed_adds
 
 
 def generate_importable_csv(filename: str, data: list[dict]):
+    rows = (item_row(item, entry["location"]) for entry in data for item in entry["items"])
     with open(filename, mode="w", newline="") as file:
-        fields = ["HB.name", "HB.quantity", "HB.location", "HB.description", "HB.purchase_from", "HB.purchase_price"]
-        writer = csv.DictWriter(file, fieldnames=fields)
+        write_rows(file, rows)
 
-        writer.writeheader()  # Write column headers
+    print(f"Generated file {filename}")
 
-        # Process each location and its items
-        for entry in data:
-            location = entry["location"]
-            for item in entry["items"]:
-                item["location"] = location
-                writer.writerow({f"HB.{key}": value for key, value in item.items()})
 
-    print(f"Generated file {filename}")
+# Index the existing items by name in the background, so new items can be merged into them
+def build_name_index(store: SnapshotStore, auth: str) -> Future | None:
+    if not config.getboolean("ADDER", "merge_duplicates", fallback=True):
+        return None
 
+    def build() -> NameIndex:
+        items = store.items() if store.enabled else get_all_items(auth, INDEX_FIELDS)
+        return NameIndex(project_item(item, INDEX_FIELDS) for item in items.values())
 
-def common_process(filename: str) -> (list[dict], list[str], list[str], str):
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="name-index")
+    future = pool.submit(build)
+    pool.shutdown(wait=False)
+    return future
+
+
+# Propose quantity merges for new items that already exist, and review them along with unknown locations
+def review(data: list[dict], locations: LocationIndex, name_index: Future | None) -> list[dict]:
+    if name_index is not None:
+        try:
+            index = name_index.result()
+        except Exception as e:
+            print(f"Could not get existing items, all items will be added as new: {e}")
+        else:
+            with span("adder find duplicates"):
+                merges = propose_merges(data, locations, index)
+            print(f"Checked {len(index)} existing items for duplicates, {merges} merges proposed!")
+
+    return check_for_errors_with_header(data, "location", "items",
+                                        only=lambda entry: entry["location"] not in locations or has_merges(entry))
+
+
+# Items are only merged into existing ones when adding straight to Homebox, not for CSV output
+def common_process(filename: str, merge_duplicates: bool = False) -> (list[dict], LocationIndex, str):
     load_dotenv()
 
-    auth = get_homebox_auth_key()
-    locations, loc_ids = get_locations(auth)
+    with span("adder login"):
+        auth = get_homebox_auth_key()
 
-    print("Locations got!")
+    # Locations and existing items are fetched in the background while the file is being transcribed
+    store = SnapshotStore(auth)
+    store.refresh("locations", get_location_tree)
+    name_index = build_name_index(store, auth) if merge_duplicates else None
 
-    text = interpret_sound_file(filename)
+    with span("adder transcribe") as current:
+        current.items = 1
+        text = interpret_sound_file(filename)
 
     print(f"Text interpreted as: {text}")
 
-    data = process_with_llm(text, locations)
+    with span("adder locations") as current:
+        locations = index_locations(store.latest("locations"))
+        current.items = len(locations)
+
+    print("Locations got!")
+
+    with span("adder structure"):
+        data = fix_locations(process_with_llm(text, locations.paths), locations)
 
     print("Formated by LLM!")
 
-    data = check_for_errors_with_header(data, "location", "items")
+    with span("adder review"):
+        data = review(data, locations, name_index)
 
     print("Data checked for errors!")
 
-    return data, locations, loc_ids, auth
+    return data, locations, auth
 
 
-# Add directly to Homebox from sound file
-def add_from_sound_file(filename: str):
-    data, locations, loc_ids, auth = common_process(filename)
+# Transcribe and structure several files at once, with one login and one review for all of them
+def batch_process(filenames: list[str], merge_duplicates: bool = False) -> (list[dict], LocationIndex, str):
+    load_dotenv()
+
+    with span("adder login"):
+        auth = get_homebox_auth_key()
+
+    store = SnapshotStore(auth)
+    store.refresh("locations", get_location_tree)
+    name_index = build_name_index(store, auth) if merge_duplicates else None
+
+    def transcribe(filename: str) -> str | None:
+        try:
+            return transcribe_sound_file(filename)
+        except Exception as e:
+            print(f"Could not interpret {filename}, skipping it: {e}")
+            return None
 
-    data = translate_locations(data, locations, loc_ids)
+    with span("adder transcribe") as current, \
+            ThreadPoolExecutor(max_workers=config.getint("ADDER", "batch_workers", fallback=4)) as pool:
+        current.items = len(filenames)
+        texts = list(pool.map(transcribe, filenames))
+
+    with span("adder locations") as current:
+        locations = index_locations(store.latest("locations"))
+        current.items = len(locations)
+
+    print("Locations got!")
+
+    interpreted = []
+    for filename, text in zip(filenames, texts):
+        if text is not None:
+            print(f"Text from {filename} interpreted as: {text}")
+            interpreted.append(text)
+
+    results = []
+    with span("adder structure") as current:
+        current.items = len(interpreted)
+        for result in process_many_with_llm(interpreted, locations.paths):
+            if isinstance(result, Exception):
+                print(f"LLM could not format a recording, skipping it: {result}")
+            else:
+                results.append(result)
+        data = fix_locations(merge_additions(results), locations)
+
+    print(f"Formated {len(results)} recordings by LLM!")
+
+    with span("adder review"):
+        data = review(data, locations, name_index)
+
+    print("Data checked for errors!")
+
+    return data, locations, auth
+
+
+# Translate locations and add checked data to Homebox
+def commit_data(data: list[dict], locations: LocationIndex, auth: str):
+    data = translate_locations(data, locations)
 
     print("Locations translated!")
 
@@ -126,13 +312,39 @@ def add_from_sound_file(filename: str):
         print("Successfully added all items!")
 
 
+# Add directly to Homebox from sound file
+def add_from_sound_file(filename: str):
+    commit_data(*common_process(filename, merge_duplicates=True))
+
+
 # Generate an importable CSV
 def csv_from_sound_file(soundfile: str, outfile: str):
-    data, _, _, _ = common_process(soundfile)
+    data, _, _ = common_process(soundfile)
 
     generate_importable_csv(outfile, data)
 
 
+# Process several sound files in parallel, then review and commit them together
+def process_files(filenames: list[str]):
+    existing = []
+    for filename in filenames:
+        if os.path.exists(filename):
+            existing.append(filename)
+        else:
+            print(f"Error: File {filename} does not exist.")
+    if not existing:
+        return
+
+    print(f"Processing {len(existing)} files")
+
+    if config.getboolean("ADDER", "output_into_csv"):
+        out_name = input("Choose name of output file (without .csv): ")
+        data, _, _ = batch_process(existing)
+        generate_importable_csv(out_name + ".csv", data)
+    else:
+        commit_data(*batch_process(existing, merge_duplicates=True))
+
+
 # Code for processing file
 def process_file(filename: str):
     if not os.path.exists(filename):
@@ -155,11 +367,24 @@ def main():
     process_file(filename)
 
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        for arg in sys.argv[1:]:
-            process_file(arg)
-    else:
-        main()
+def run(args: argparse.Namespace):
+    if args.resync:
+        override_config("SNAPSHOT", "force_resync", True)
+    if args.no_transcript_cache:
+        override_config("CACHE", "transcripts", False)
+    if args.no_llm_cache:
+        override_config("CACHE", "adder_llm", False)
+
+    with traced_run("adder", profile=args.profile):
+        if len(args.files) > 1:
+            process_files(args.files)
+        elif args.files:
+            process_file(args.files[0])
+        else:
+            main()
 
     end_safely(0)
+
+
+if __name__ == "__main__":
+    run(parse_command("add"))
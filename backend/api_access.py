@@ -1,68 +1,244 @@
-import os
-import requests
-
+from backend.general import config, project_root, parse_time
+from backend.locations import LocationIndex
+from backend.tracing import span, homebox_route
 
-# Fetch authentication token for Homebox API
+import os
+import json
+import math
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, TYPE_CHECKING
+
+# requests is imported when the client is created, so tools start without waiting for it
+if TYPE_CHECKING:
+    import requests
+
+
+# Raised when Homebox rejects the authentication token
+class HomeboxAuthError(Exception):
+    pass
+
+
+# Persistent, connection-pooled client for the Homebox API
+class HomeboxClient:
+    def __init__(self, base_url: str, pool_size: int = 10, timeout: float = 30,
+                 retries: int = 3, backoff_factor: float = 0.5):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        # Retries only cover idempotent methods, so a failed POST never creates an item twice
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
+        self.tokens: TokenManager | None = None
+
+    # With a token manager, stale tokens are swapped for the current one,
+    # and a rejected token triggers one new login before the request is retried
+    def request(self, method: str, path: str, auth_key: str = None,
+                retry_auth: bool = True, **kwargs) -> "requests.Response":
+        headers = kwargs.pop("headers", {})
+        kwargs.setdefault("timeout", self.timeout)
+        if auth_key and self.tokens and retry_auth:
+            auth_key = self.tokens.current(auth_key)
+
+        def send(key: str) -> "requests.Response":
+            if key:
+                headers["Authorization"] = key
+            return self.session.request(method, f"{self.base_url}{path}", headers=headers, **kwargs)
+
+        with span(homebox_route(method, path)) as current:
+            res = send(auth_key)
+
+            if auth_key and res.status_code == 401 and self.tokens and retry_auth:
+                res = send(self.tokens.reauthenticate(auth_key))
+            current.bytes = len(res.content)
+        if auth_key and res.status_code == 401:
+            raise HomeboxAuthError(f"Homebox rejected the auth token for {method} {path}")
+        return res
+
+    def get(self, path: str, auth_key: str = None, **kwargs) -> "requests.Response":
+        return self.request("GET", path, auth_key, **kwargs)
+
+    def post(self, path: str, auth_key: str = None, **kwargs) -> "requests.Response":
+        return self.request("POST", path, auth_key, **kwargs)
+
+    def put(self, path: str, auth_key: str = None, **kwargs) -> "requests.Response":
+        return self.request("PUT", path, auth_key, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+# Keeps the Homebox login token in a file only readable by the user, and reuses it until it is close to expiring
+class TokenManager:
+    def __init__(self, client: HomeboxClient, path: str, refresh_margin: float = 3600):
+        self.client = client
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self.token: str | None = None
+        self.expires: datetime | None = None
+        self.stale: set[str] = set()
+        self.lock = threading.RLock()
+
+    # The token file belongs to one server and user, a token for another one is ignored
+    def owner(self) -> dict:
+        return {"url": os.getenv("HOMEBOX_URL"), "username": os.getenv("HOMEBOX_USERNAME")}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return
+        if {key: saved.get(key) for key in ("url", "username")} == self.owner():
+            self.token = saved["token"]
+            self.expires = parse_time(saved["expiresAt"])
+
+    def save(self, res_data: dict):
+        if self.token:
+            self.stale.add(self.token)
+        self.token = res_data["token"]
+        self.expires = parse_time(res_data["expiresAt"])
+
+        descriptor = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({**self.owner(), "token": self.token, "expiresAt": res_data["expiresAt"]}, file)
+        os.chmod(self.path, 0o600)
+
+    def seconds_left(self) -> float:
+        return (self.expires - datetime.now(timezone.utc)).total_seconds()
+
+    def login(self):
+        data = {
+            "password": os.getenv("HOMEBOX_PASSWORD"),
+            "stayLoggedIn": True,
+            "username": os.getenv("HOMEBOX_USERNAME")
+        }
+
+        res = self.client.post("/api/v1/users/login", json=data)
+
+        if "application/json" not in res.headers.get("Content-Type", ""):
+            print("Unexpected response format:", res.text)
+            raise ValueError("Server did not return JSON.")
+
+        self.save(res.json())
+
+    # Swap a still valid token for a new one, falling back to a full login if Homebox refuses
+    def refresh(self):
+        import requests
+
+        try:
+            res = self.client.get("/api/v1/users/refresh", self.token, retry_auth=False)
+            if res.status_code == 200:
+                self.save(res.json())
+                return
+        except (HomeboxAuthError, requests.RequestException, KeyError, ValueError):
+            pass
+        self.login()
+
+    def get_token(self) -> str:
+        with self.lock:
+            if self.token is None:
+                self.load()
+            if self.token is None or self.seconds_left() <= 0:
+                self.login()
+            elif self.seconds_left() < self.refresh_margin:
+                self.refresh()
+            return self.token
+
+    # Current token for a request, refreshed first if it is about to expire
+    def current(self, auth_key: str) -> str:
+        if auth_key != self.token and auth_key not in self.stale:
+            return auth_key  # Not one of ours, leave it alone
+        if self.expires is not None and self.seconds_left() >= self.refresh_margin:
+            return self.token
+        return self.get_token()
+
+    # Log in again after Homebox rejected a token, unless another thread already did
+    def reauthenticate(self, rejected: str) -> str:
+        with self.lock:
+            if self.token == rejected or self.token is None:
+                self.login()
+            return self.token
+
+
+_client: HomeboxClient | None = None
+
+
+# Shared client used by all API functions, created on first use
+def get_client() -> HomeboxClient:
+    global _client
+    if _client is None:
+        _client = HomeboxClient(
+            os.getenv("HOMEBOX_URL", ""),
+            pool_size=config.getint("HOMEBOX", "pool_size", fallback=10),
+            timeout=config.getfloat("HOMEBOX", "timeout", fallback=30),
+            retries=config.getint("HOMEBOX", "retries", fallback=3),
+            backoff_factor=config.getfloat("HOMEBOX", "backoff_factor", fallback=0.5)
+        )
+        _client.tokens = TokenManager(
+            _client,
+            os.path.join(project_root, "..", config.get("HOMEBOX", "token_file", fallback=".homebox_token")),
+            refresh_margin=config.getfloat("HOMEBOX", "token_refresh_hours", fallback=1) * 3600
+        )
+    return _client
+
+
+# Fetch authentication token for Homebox API, reusing the saved one from earlier runs when still valid
 def get_homebox_auth_key() -> str:
     if not all([os.getenv("HOMEBOX_URL"), os.getenv("HOMEBOX_USERNAME"), os.getenv("HOMEBOX_PASSWORD")]):
         raise ValueError("Missing environment variables for Homebox authentication.")
 
-    url = f"{os.getenv('HOMEBOX_URL')}/api/v1/users/login"
-    headers = {"Accept": "application/json", "Content-Type": "application/json"}
-    data = {
-        "password": os.getenv("HOMEBOX_PASSWORD"),
-        "stayLoggedIn": True,
-        "username": os.getenv("HOMEBOX_USERNAME")
-    }
-
-    res = requests.post(url, headers=headers, json=data)
-
-    if "application/json" not in res.headers.get("Content-Type", ""):
-        print("Unexpected response format:", res.text)
-        raise ValueError("Server did not return JSON.")
+    return get_client().tokens.get_token()
 
-    res_data = res.json()
 
-    return res_data["token"]
+# Retrieve the raw location tree from Homebox
+def get_location_tree(auth_key: str) -> list[dict]:
+    res = get_client().get("/api/v1/locations/tree", auth_key)
 
+    return res.json()
 
-# Retrieve locations from Homebox and structure them in a list, with accompanying ID list
-def get_locations(auth_key: str) -> (list[str], list[str]):
-    url = f"{os.getenv('HOMEBOX_URL')}/api/v1/locations/tree"
-    headers = {"Authorization": f"{auth_key}", "Accept": "application/json"}
-    res = requests.get(url, headers=headers)
 
-    location_list = res.json()
-
-    locations: list[str] = []
-    ids: list[str] = []
+# Index a location tree by full path
+def index_locations(location_list: list[dict]) -> LocationIndex:
+    index = LocationIndex()
     for location in location_list:
-        locs, idss = helper_location_tree(location)
-        locations.extend(locs)
-        ids.extend(idss)
+        helper_location_tree(location, index)
+
+    return index
 
-    return locations, ids
 
+# Retrieve locations from Homebox and index them by their full path
+def get_locations(auth_key: str) -> LocationIndex:
+    return index_locations(get_location_tree(auth_key))
 
-# Recursively process location tree
-def helper_location_tree(node: dict) -> (list[str], list[str]):
-    name = node["name"]
-    locations = [name]
-    ids = [node["id"]]
-    for child in node["children"]:
-        sub_locations, sub_ids = helper_location_tree(child)
-        for s_loc in sub_locations:
-            locations.append(f"{name}/{s_loc}")
-        ids.extend(sub_ids)
 
-    return locations, ids
+# Flatten a location tree into the index, without recursion and building each path once
+def helper_location_tree(node: dict, index: LocationIndex):
+    index.add_tree(node)
 
 
 # Get all labels from Homebox instance and return as list with names as keys
 def get_labels(auth_key: str) -> dict:
-    url = f"{os.getenv('HOMEBOX_URL')}/api/v1/labels"
-    headers = {"Authorization": f"{auth_key}", "Accept": "application/json"}
-    res = requests.get(url, headers=headers)
+    res = get_client().get("/api/v1/labels", auth_key)
 
     res_dict = res.json()
     return_dict = {}
@@ -73,28 +249,96 @@ def get_labels(auth_key: str) -> dict:
     return return_dict
 
 
-# Get all items in Homebox storage into a dict with ID as key
-def get_all_items(auth_key: str) -> dict:
-    url = f"{os.getenv('HOMEBOX_URL')}/api/v1/items"
-    headers = {"Authorization": f"{auth_key}", "Accept": "application/json"}
-    res = requests.get(url, headers=headers)
+# Keep only the requested fields of an item, or the whole item if no fields are given
+def project_item(item: dict, fields: list[str] = None) -> dict:
+    if not fields:
+        return item
+    return {key: item[key] for key in fields if key in item}
+
+
+# Stream all items in Homebox storage page by page
+# Up to `prefetch` later pages are fetched in the background while earlier ones are consumed
+# Items can be ordered by e.g. "updatedAt", which Homebox returns newest first
+def iter_items(auth_key: str, fields: list[str] = None, page_size: int = None,
+               prefetch: int = None, order_by: str = None) -> Iterator[dict]:
+    if page_size is None:
+        page_size = config.getint("HOMEBOX", "page_size", fallback=100)
+    if prefetch is None:
+        prefetch = config.getint("HOMEBOX", "prefetch_pages", fallback=4)
+    client = get_client()
+
+    def page_params(page: int) -> dict:
+        params = {"page": page, "pageSize": page_size}
+        if order_by:
+            params["orderBy"] = order_by
+        return params
+
+    def fetch_page(page: int) -> list[dict]:
+        res = client.get("/api/v1/items", auth_key, params=page_params(page))
+        return res.json()["items"]
+
+    first = client.get("/api/v1/items", auth_key, params=page_params(1)).json()
+    total = first.get("total", len(first["items"]))
+    pages = math.ceil(total / page_size) if page_size else 1
+
+    if pages <= 1 or len(first["items"]) >= total:
+        for item in first["items"]:
+            yield project_item(item, fields)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=max(1, prefetch))
+    pending = deque()
+    next_page = 2
+    try:
+        while next_page <= pages and len(pending) < max(1, prefetch):
+            pending.append(pool.submit(fetch_page, next_page))
+            next_page += 1
+
+        for item in first["items"]:
+            yield project_item(item, fields)
+
+        while pending:
+            page_items = pending.popleft().result()
+            if next_page <= pages:
+                pending.append(pool.submit(fetch_page, next_page))
+                next_page += 1
+            for item in page_items:
+                yield project_item(item, fields)
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
 
-    res_dict = res.json()
+
+# Get all items in Homebox storage into a dict with ID as key
+def get_all_items(auth_key: str, fields: list[str] = None) -> dict:
     return_dict = {}
 
-    for item in res_dict["items"]:
+    for item in iter_items(auth_key, fields):
         return_dict[item["id"]] = item
 
     return return_dict
 
 
+# Number of items in Homebox storage, without fetching them
+def get_item_count(auth_key: str) -> int:
+    res = get_client().get("/api/v1/items", auth_key, params={"page": 1, "pageSize": 1})
+
+    return res.json()["total"]
+
+
+# Get the full data of a single item, as needed before replacing it with update_item
+def get_item(auth_key: str, item_id: str) -> dict:
+    res = get_client().get(f"/api/v1/items/{item_id}", auth_key)
+
+    return res.json()
+
+
 # Add an item to Homebox using the Homebox API
 def add_item(item: dict, auth_key: str) -> bool:
-    url = f"{os.getenv('HOMEBOX_URL')}/api/v1/items"
-    headers = {"Authorization": f"{auth_key}", "Accept": "application/json", "Content-Type": "application/json"}
     data = {key: value for key, value in item.items()}
 
-    res = requests.post(url, headers=headers, json=data)
+    res = get_client().post("/api/v1/items", auth_key, json=data)
 
     if res.status_code == 201:
         return True
@@ -103,9 +347,6 @@ def add_item(item: dict, auth_key: str) -> bool:
 
 # This replaces the item! Remember to submit with gotten data, not just the patched data.
 def update_item(auth_key: str, item_id: str, item_data: dict) -> bool:
-    url = f"{os.getenv('HOMEBOX_URL')}/api/v1/items/{item_id}"
-    headers = {"Authorization": f"{auth_key}", "Accept": "application/json", "Content-Type": "application/json"}
-
     item_data["locationId"] = item_data["location"]["id"]
     item_data["labelIds"] = []
     for label in item_data.get("labels", []):
@@ -116,7 +357,7 @@ def update_item(auth_key: str, item_id: str, item_data: dict) -> bool:
     else:
         item_data["parentId"] = None
 
-    res = requests.put(url, headers=headers, json=item_data)
+    res = get_client().put(f"/api/v1/items/{item_id}", auth_key, json=item_data)
 
     if res.status_code == 200:
         return True
@@ -0,0 +1,76 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+NOT_ATTEMPTED = None
+
+
+# Spaces out calls so no more than `rate` start per second, 0 disables the limit
+class RateLimiter:
+    def __init__(self, rate: float = 0):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+@dataclass
+class BulkResult:
+    results: list[Any] = field(default_factory=list)  # One result per task, in task order
+    error: Exception | None = None                     # Error that stopped the run early, if any
+    elapsed: float = 0
+
+
+# Run worker on every task with bounded concurrency
+# A task that raises is tried again up to `retries` times, waiting a little longer each time
+# Results keep task order, failed tasks hold their exception,
+# and tasks never started after a stop error are left as NOT_ATTEMPTED
+def run_bulk(tasks: list, worker: Callable[[Any], Any], max_workers: int = 4,
+             requests_per_second: float = 0, stop_on: tuple = (), retries: int = 0,
+             backoff: float = 0.5) -> BulkResult:
+    limiter = RateLimiter(requests_per_second)
+    stop = threading.Event()
+    result = BulkResult(results=[NOT_ATTEMPTED] * len(tasks))
+    start = time.perf_counter()
+
+    def run(index: int, task):
+        if stop.is_set():
+            return
+        limiter.wait()
+        if stop.is_set():
+            return
+        for attempt in range(retries + 1):
+            try:
+                result.results[index] = worker(task)
+                return
+            except stop_on:
+                stop.set()
+                raise
+            except Exception as e:  # A single failing task should not take the rest down with it
+                result.results[index] = e
+                if attempt < retries and not stop.is_set():
+                    time.sleep(backoff * 2 ** attempt)
+                    limiter.wait()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = [pool.submit(run, index, task) for index, task in enumerate(tasks)]
+        for future in futures:
+            try:
+                future.result()
+            except stop_on as e:
+                if result.error is None:
+                    result.error = e
+
+    result.elapsed = time.perf_counter() - start
+    return result
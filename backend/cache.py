@@ -0,0 +1,90 @@
+from backend.general import config, project_root
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any
+
+
+# Stable hash of any JSON serializable values, used as cache key
+def make_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Persistent key/value cache in SQLite, split into namespaces, with size and age based eviction
+class ResultCache:
+    def __init__(self, namespace: str, path: str = None, max_entries: int = None, max_age_days: float = None):
+        if path is None:
+            path = os.path.join(project_root, "..", config.get("CACHE", "path", fallback="cache.sqlite3"))
+        if max_entries is None:
+            max_entries = config.getint("CACHE", "max_entries", fallback=100000)
+        if max_age_days is None:
+            max_age_days = config.getfloat("CACHE", "max_age_days", fallback=30)
+
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                               namespace TEXT NOT NULL,
+                               key TEXT NOT NULL,
+                               value TEXT NOT NULL,
+                               created REAL NOT NULL,
+                               accessed REAL NOT NULL,
+                               PRIMARY KEY (namespace, key))""")
+        self.evict()
+
+    def get(self, key: str) -> Any | None:
+        with self.lock:
+            row = self.db.execute("SELECT value, created FROM cache WHERE namespace = ? AND key = ?",
+                                  (self.namespace, key)).fetchone()
+            if row is None:
+                return None
+            if self.max_age and row[1] < time.time() - self.max_age:
+                return None
+            self.db.execute("UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?",
+                            (time.time(), self.namespace, key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                            (self.namespace, key, json.dumps(value), now, now))
+            self.db.commit()
+
+    # Store many values in one transaction
+    def put_many(self, entries: dict[str, Any]):
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                                [(self.namespace, key, json.dumps(value), now, now)
+                                 for key, value in entries.items()])
+            self.db.commit()
+
+    # Drop expired entries, then the least recently used ones above max_entries
+    def evict(self):
+        with self.lock:
+            if self.max_age:
+                self.db.execute("DELETE FROM cache WHERE namespace = ? AND created < ?",
+                                (self.namespace, time.time() - self.max_age))
+            if self.max_entries:
+                self.db.execute("""DELETE FROM cache WHERE namespace = ? AND key NOT IN (
+                                       SELECT key FROM cache WHERE namespace = ?
+                                       ORDER BY accessed DESC LIMIT ?)""",
+                                (self.namespace, self.namespace, self.max_entries))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+            self.db.commit()
+
+    def close(self):
+        self.evict()
+        self.db.close()
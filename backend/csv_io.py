@@ -0,0 +1,232 @@
+from backend.general import config
+from backend.api_access import get_locations, get_labels, iter_items, add_item, HomeboxAuthError
+from backend.bulk import run_bulk, NOT_ATTEMPTED
+from backend.locations import LocationIndex
+from backend.tracing import span
+
+import os
+import csv
+import json
+import threading
+from itertools import islice
+from typing import Iterable, Iterator, TextIO
+
+# Columns in the Homebox CSV format, as written by the adder and the exporter
+CSV_FIELDS = ["HB.name", "HB.quantity", "HB.location", "HB.description", "HB.labels",
+              "HB.purchase_from", "HB.purchase_price"]
+LABEL_SEPARATOR = ";"
+
+
+# A Homebox CSV row from an item, with location and labels given by their names
+def item_row(item: dict, location: str = None) -> dict:
+    row = {
+        "HB.name": item.get("name", ""),
+        "HB.quantity": item.get("quantity", ""),
+        "HB.location": location if location is not None else item.get("location", ""),
+        "HB.description": item.get("description", ""),
+        "HB.purchase_from": item.get("purchaseFrom", item.get("purchase_from", "")),
+        "HB.purchase_price": item.get("purchasePrice", item.get("purchase_price", ""))
+    }
+    labels = item.get("labels") or []
+    row["HB.labels"] = LABEL_SEPARATOR.join(label["name"] if isinstance(label, dict) else label for label in labels)
+    return row
+
+
+# Write rows as they come, so memory does not grow with the number of items
+def write_rows(file: TextIO, rows: Iterable[dict]) -> int:
+    writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+# Export the whole inventory page by page
+def export_items(filename: str, auth_key: str) -> int:
+    locations = get_locations(auth_key)
+
+    def rows() -> Iterator[dict]:
+        for item in iter_items(auth_key):
+            location = item.get("location")
+            path = locations.path_of(location["id"]) if location else None
+            yield item_row(item, path or "")
+
+    with span("csv export") as current, open(filename, mode="w", newline="") as file:
+        current.items = write_rows(file, rows())
+        return current.items
+
+
+# Rows of a Homebox CSV, numbered from 1, in chunks of chunk_size, starting after the first `skip` rows
+def iter_chunks(file: TextIO, chunk_size: int, skip: int = 0) -> Iterator[list[tuple[int, dict]]]:
+    rows = enumerate(csv.DictReader(file), start=1)
+    for _ in islice(rows, skip):
+        pass
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Progress of an import, saved after every added row so a failed or stopped import can continue where it was
+class Checkpoint:
+    def __init__(self, filename: str):
+        self.path = filename + ".checkpoint"
+        self.source = os.path.abspath(filename)
+        self.size = os.path.getsize(filename)
+        self.done = 0                    # Rows up to this one are handled
+        self.done_after: list[int] = []  # Rows after `done` that are already handled
+        self.added = 0
+        self.failed = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as file:
+            saved = json.load(file)
+        if saved.get("source") != self.source or saved.get("size") != self.size:
+            print("Checkpoint is for another version of this file, starting from the beginning.")
+            return
+        self.done = saved["done"]
+        self.done_after = saved.get("done_after", [])
+        self.added = saved.get("added", 0)
+        self.failed = saved.get("failed", 0)
+
+    def save(self):
+        with open(self.path + ".tmp", 'w') as file:
+            json.dump({"source": self.source, "size": self.size, "done": self.done, "done_after": self.done_after,
+                       "added": self.added, "failed": self.failed}, file)
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Turn a CSV row into the data Homebox needs to create an item, raising ValueError if it cannot be placed
+def row_to_item(row: dict, locations: LocationIndex, labels: dict) -> dict:
+    name = (row.get("HB.name") or "").strip()
+    if not name:
+        raise ValueError("row has no name")
+    location = (row.get("HB.location") or "").strip()
+    loc_id = locations.resolve(location)
+    if loc_id is None:
+        raise ValueError(f"location '{location}' does not exist in Homebox")
+
+    item = {"name": name, "description": row.get("HB.description") or "", "locationId": loc_id}
+    quantity = (row.get("HB.quantity") or "").strip()
+    item["quantity"] = int(quantity) if quantity else 1
+
+    label_ids = []
+    for label in (row.get("HB.labels") or "").split(LABEL_SEPARATOR):
+        label = label.strip()
+        if not label:
+            continue
+        if label not in labels:
+            raise ValueError(f"label '{label}' does not exist in Homebox")
+        label_ids.append(labels[label]["id"])
+    if label_ids:
+        item["labelIds"] = label_ids
+    return item
+
+
+# Import a Homebox CSV, creating several items at a time and one chunk of rows at a time
+# Rows that fail are written to <file>.failed.csv, which can be fixed and imported on its own
+# A rejected login or a lost connection stops the import, running it again continues with the rows not yet added
+def import_items(filename: str, auth_key: str, restart: bool = False) -> Checkpoint:
+    from requests import ConnectionError
+
+    chunk_size = config.getint("CSV", "chunk_size", fallback=500)
+    locations = get_locations(auth_key)
+    labels = get_labels(auth_key)
+
+    checkpoint = Checkpoint(filename)
+    if not restart:
+        checkpoint.load()
+    if checkpoint.done:
+        print(f"Continuing import of {filename} after row {checkpoint.done}.")
+
+    failed_name = filename + ".failed.csv"
+    append = checkpoint.done > 0 and os.path.exists(failed_name)
+    with open(filename, mode="r", newline="") as file, \
+            open(failed_name, mode="a" if append else "w", newline="") as failed_file:
+        failed_writer = csv.DictWriter(failed_file, fieldnames=CSV_FIELDS + ["error"], extrasaction="ignore")
+        if not append:
+            failed_writer.writeheader()
+
+        def fail(row: dict, number: int, reason):
+            print(f"Row {number} ({row.get('HB.name', '')}) could not be added: {reason}")
+            failed_writer.writerow({**row, "error": str(reason)})
+            checkpoint.failed += 1
+
+        # Every added row is saved to the checkpoint right away, so stopping mid chunk never adds a row twice
+        lock = threading.Lock()
+
+        def add(task: tuple[int, dict]) -> bool:
+            number, item = task
+            added = add_item(item, auth_key)
+            if added:
+                with lock:
+                    checkpoint.added += 1
+                    checkpoint.done_after.append(number)
+                    checkpoint.save()
+            return added
+
+        stop_on = (HomeboxAuthError, ConnectionError)
+        for chunk in iter_chunks(file, chunk_size, checkpoint.done):
+            handled = set(checkpoint.done_after)
+            outcomes = {}  # Row number -> True if added, or why it failed
+            tasks = []
+            for number, row in chunk:
+                if number in handled:
+                    continue
+                try:
+                    tasks.append((number, row_to_item(row, locations, labels)))
+                except ValueError as e:
+                    outcomes[number] = e
+
+            with span("csv import chunk") as current:
+                current.items = len(tasks)
+                result = run_bulk(
+                    tasks,
+                    add,
+                    max_workers=config.getint("BULK", "max_workers", fallback=4),
+                    requests_per_second=config.getfloat("BULK", "requests_per_second", fallback=0),
+                    stop_on=stop_on
+                )
+            for (number, _), res in zip(tasks, result.results):
+                if res is not NOT_ATTEMPTED and not isinstance(res, stop_on):
+                    outcomes[number] = res if res is True or isinstance(res, Exception) else "Homebox did not accept it"
+
+            # Only rows before the first one that was never tried count as done, later handled rows are listed
+            stopped_at = None
+            for number, row in chunk:
+                if number in handled:
+                    continue
+                if number not in outcomes:
+                    stopped_at = number if stopped_at is None else stopped_at
+                    continue
+                if outcomes[number] is not True:  # Added rows are already in the checkpoint
+                    fail(row, number, outcomes[number])
+                    checkpoint.done_after.append(number)
+
+            failed_file.flush()
+            if result.error:
+                checkpoint.done = stopped_at - 1 if stopped_at is not None else chunk[-1][0]
+                checkpoint.done_after = [number for number in checkpoint.done_after if number > checkpoint.done]
+                checkpoint.save()
+                reason = "rejected the login" if isinstance(result.error, HomeboxAuthError) else "could not be reached"
+                print(f"Homebox {reason}, run the import again to continue after row {checkpoint.done}.")
+                return checkpoint
+
+            checkpoint.done = chunk[-1][0]
+            checkpoint.done_after = []
+            checkpoint.save()
+            print(f"Imported {checkpoint.done} rows, {checkpoint.added} added and {checkpoint.failed} failed.")
+
+    checkpoint.remove()
+    if not checkpoint.failed:
+        os.remove(failed_name)
+    return checkpoint
@@ -0,0 +1,97 @@
+from backend.general import config
+from backend.api_access import get_item, update_item
+from backend.locations import LocationIndex
+
+import difflib
+from typing import Iterable
+
+# Only these fields are needed to find duplicates, the full item is fetched again before merging
+INDEX_FIELDS = ["id", "name", "quantity", "location"]
+
+
+# Lowercase, collapse whitespace and drop a plural s, so "Glass jars" matches "glass jar"
+def normalize_name(name: str) -> str:
+    words = []
+    for word in name.lower().split():
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return " ".join(words)
+
+
+# Existing items by location and normalized name, built once and shared by every location in a run
+# Fuzzy matching only compares names within the one location, never the whole inventory
+class NameIndex:
+    def __init__(self, items: Iterable[dict] = ()):
+        self.by_location: dict[str, dict[str, dict]] = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item: dict):
+        location = item.get("location")
+        if not location:
+            return
+        names = self.by_location.setdefault(location["id"], {})
+        names.setdefault(normalize_name(item["name"]), item)  # The first of several same named items wins
+
+    def __len__(self) -> int:
+        return sum(len(names) for names in self.by_location.values())
+
+    # Existing item in the location with the same or a close enough name
+    def find(self, name: str, location_id: str, cutoff: float = 0.9) -> dict | None:
+        names = self.by_location.get(location_id)
+        if not names:
+            return None
+        key = normalize_name(name)
+        if key in names:
+            return names[key]
+        matches = difflib.get_close_matches(key, names.keys(), n=1, cutoff=cutoff)
+        return names[matches[0]] if matches else None
+
+
+def quantity_of(item: dict) -> int:
+    try:
+        return int(item.get("quantity") or 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+# Turn new items that already exist in their location into quantity merges, shown as ::id:: in the review
+# Items keep their dictated name and quantity, and several new items merging into the same one are combined
+def propose_merges(data: list[dict], locations: LocationIndex, index: NameIndex) -> int:
+    cutoff = config.getfloat("ADDER", "duplicate_match_cutoff", fallback=0.9)
+    merges = {}
+    for entry in data:
+        loc_id = locations.resolve(entry["location"])
+        if loc_id is None:
+            continue
+
+        kept = []
+        for item in entry["items"]:
+            existing = index.find(item["name"], loc_id, cutoff)
+            if existing is None:
+                kept.append(item)
+            elif existing["id"] in merges:
+                merges[existing["id"]]["quantity"] += quantity_of(item)
+            else:
+                print(f"{item['name']} already exists in {entry['location']} as {existing['name']}, "
+                      f"proposing to add to its quantity.")
+                item["id"] = existing["id"]
+                item["quantity"] = quantity_of(item)
+                merges[existing["id"]] = item
+                kept.append(item)
+        entry["items"] = kept
+
+    return len(merges)
+
+
+def has_merges(entry: dict) -> bool:
+    return any("id" in item for item in entry["items"])
+
+
+# Add the reviewed quantity to an existing item
+# The full item is fetched right before replacing it, so changes made since the snapshot are kept
+def merge_item(item: dict, auth_key: str) -> bool:
+    existing = get_item(auth_key, item["id"])
+    existing["quantity"] = quantity_of(existing) + quantity_of(item)
+    return update_item(auth_key, item["id"], existing)
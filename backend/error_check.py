@@ -1,110 +1,205 @@
+from backend.general import config
+from backend.tracing import span
+
 import os
 import re
 import subprocess
-from typing import TextIO
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, TextIO
 
 TEMP_FILE = "temp"
 PROPERTY_ORDER = ["id", "quantity", "name", "description", "purchaseFrom", "purchasePrice", "labels"]
-LOAD_PATTERN = r"::(\w+)::\s*(.*?)(?=\s+::|\s*$)"
+KEY_PATTERN = re.compile(r"::(\w+)::")
+
+
+# A location header line, <name>
+@dataclass(slots=True)
+class Header:
+    line: int
+    name: str
+
+
+# An item line, ::key:: value ::key:: value, where a repeated key collects its values in a list
+@dataclass(slots=True)
+class Record:
+    line: int
+    fields: dict = field(default_factory=dict)
+
+
+# Result of comparing reviewed records with the originals
+@dataclass(slots=True)
+class ReviewDiff:
+    added: list[dict] = field(default_factory=list)
+    modified: list[dict] = field(default_factory=list)
+    deleted: list[dict] = field(default_factory=list)
+    unchanged: list[dict] = field(default_factory=list)
+
+    @property
+    def changed(self) -> list[dict]:
+        return self.added + self.modified
+
+
+class ParseError(ValueError):
+    def __init__(self, filename: str, line: int, message: str):
+        super().__init__(f"{filename}, line {line}: {message}")
+        self.line = line
+
+
+def add_field(fields: dict, key: str, value: str):
+    if key in fields:
+        if isinstance(fields[key], list):
+            fields[key].append(value)
+        else:
+            fields[key] = [fields[key], value]
+    else:
+        fields[key] = value
+
+
+def parse_record(text: str, line: int, filename: str) -> Record:
+    parts = KEY_PATTERN.split(text)  # [text before first key, key, value, key, value, ...]
+    if len(parts) == 1:
+        raise ParseError(filename, line, "line contains '::' but no ::key:: markers")
+    if parts[0].strip():
+        raise ParseError(filename, line, f"text before the first ::key:: marker: '{parts[0].strip()}'")
+
+    fields = {}
+    for index in range(1, len(parts), 2):
+        key = parts[index]
+        value = parts[index + 1].strip()
+        if key in fields:
+            add_field(fields, key, value)
+        else:
+            fields[key] = value
+    return Record(line, fields)
+
+
+# Read the error check format one line at a time, yielding headers and records as they are parsed
+def iter_file(file: TextIO, filename: str = TEMP_FILE) -> Iterator[Header | Record]:
+    for number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if "::" in line:
+            yield parse_record(line, number, filename)
+        elif line.startswith("<") and line.endswith(">"):
+            yield Header(number, line[1:-1])  # Strip the < and >
+        else:
+            raise ParseError(filename, number, f"not a <location>, an ::key:: item or a # comment: '{line}'")
+
+
+# Writes items in the error check format, one at a time
+class RecordWriter:
+    def __init__(self, file: TextIO):
+        self.file = file
+
+    def comment(self, text: str):
+        for line in text.splitlines():
+            self.file.write(f"# {line}\n")
+
+    def header(self, name: str):
+        self.file.write(f"<{name}>\n")
+
+    def record(self, item: dict):
+        write_to_file_inner(self.file, item)
+
+    def records(self, items: Iterable[dict]):
+        for item in items:
+            self.record(item)
 
 
 def write_to_file_inner(file: TextIO, item: dict):
+    parts = []
     for prop in PROPERTY_ORDER:
         if prop in item and item[prop]:
-            if isinstance(item[prop], list) :
+            if isinstance(item[prop], list):
                 for list_item in item[prop]:
-                    file.write(f"::{prop}:: {list_item} ")
+                    parts.append(f"::{prop}:: {list_item} ")
             else:
-                file.write(f"::{prop}:: {item[prop]} ")
-    file.write("\n")
+                parts.append(f"::{prop}:: {item[prop]} ")
+    parts.append("\n")
+    file.write("".join(parts))
 
 
-def write_to_file(filename: str, data: list[dict]):
+def write_to_file(filename: str, data: Iterable[dict]):
     with open(filename, 'w') as file:
-        file.write("# Use this file to fix any errors made by the AI\n")
-
-        for item in data:
-            write_to_file_inner(file, item)
+        writer = RecordWriter(file)
+        writer.comment("Use this file to fix any errors made by the AI")
+        writer.records(data)
 
 
 # Write data to file for error check, with header
-def write_to_file_with_header(filename: str, data: list[dict],
+def write_to_file_with_header(filename: str, data: Iterable[dict],
                               header_name: str = "location", entry_name: str = "items"):
 
     with open(filename, 'w') as file:
-
-        file.write("""# Use this file to fix any errors made by the AI
-# If location is <error>, make sure to assign a correct location!
-# eg 'Kitchen' or 'Storage Room/Shelf 1/Box 4'.
-""")
+        writer = RecordWriter(file)
+        writer.comment("""Use this file to fix any errors made by the AI
+If location is <error>, make sure to assign a correct location!
+eg 'Kitchen' or 'Storage Room/Shelf 1/Box 4'.
+Items with an ::id:: are added to the quantity of that existing item, remove the ::id:: to add them as new.""")
 
         for entry in data:
-            file.write(f"<{entry[header_name]}>\n")
-            for item in entry[entry_name]:
-                write_to_file_inner(file, item)
+            writer.header(entry[header_name])
+            writer.records(entry[entry_name])
 
 
 # Load after file editing is complete
 def load_from_file(filename: str) -> list[dict]:
-    updated_data = []
-
     with open(filename, 'r') as file:
-        lines = file.readlines()
-
-        for line in lines:
-            line = line.strip()
-            if "::" in line:
-                matches = re.findall(LOAD_PATTERN, line)
-                res_dict = {}
-                for key, value in matches:
-                    if key in res_dict:
-                        if isinstance(res_dict[key], list):
-                            res_dict[key].append(value)
-                        else:
-                            res_dict[key] = [res_dict[key], value]
-                    else:
-                        res_dict[key] = value
-                updated_data.append(res_dict)
-
-    return updated_data
+        return [token.fields for token in iter_file(file, filename) if isinstance(token, Record)]
 
 
 # Load after file editing is complete, with header
 def load_from_file_with_header(filename: str, header_name: str = "location", entry_name: str = "items") -> list[dict]:
     updated_data = []
-    current_header = None
-    current_entries = []
+    current_entries = None
 
     with open(filename, 'r') as file:
-        lines = file.readlines()
-
-        for line in lines:
-            line = line.strip()
-            if "::" in line:
-                matches = re.findall(LOAD_PATTERN, line)
-                res_dict = {}
-                for key, value in matches:
-                    if key in res_dict:
-                        if isinstance(res_dict[key], list):
-                            res_dict[key].append(value)
-                        else:
-                            res_dict[key] = [res_dict[key], value]
-                    else:
-                        res_dict[key] = value
-                current_entries.append(res_dict)
-            elif line.startswith('<') and line.endswith('>'):
-                if current_header:
-                    updated_data.append({header_name: current_header, entry_name: current_entries})
-
-                current_header = line[1:-1]  # Strip the < and >
+        for token in iter_file(file, filename):
+            if isinstance(token, Header):
                 current_entries = []
-
-        if current_header:
-            updated_data.append({header_name: current_header, entry_name: current_entries})
+                updated_data.append({header_name: token.name, entry_name: current_entries})
+            elif current_entries is None:
+                raise ParseError(filename, token.line, f"item is not under a <{header_name}> line")
+            else:
+                current_entries.append(token.fields)
 
     return updated_data
 
 
+# Comparable form of a record as it would be written to the file, with list order ignored
+def canonical(item: dict) -> tuple:
+    values = []
+    for prop in PROPERTY_ORDER:
+        if prop in item and item[prop]:
+            value = item[prop]
+            if isinstance(value, list):
+                value = tuple(sorted(str(list_item) for list_item in value))
+                if len(value) == 1:
+                    value = value[0]  # A single list item is read back as a plain value
+            values.append((prop, str(value) if not isinstance(value, tuple) else value))
+    return tuple(values)
+
+
+# Compare records by key, so only what actually changed has to be sent on
+def diff_records(original: list[dict], edited: list[dict], key: str = "id") -> ReviewDiff:
+    diff = ReviewDiff()
+    originals = {item[key]: item for item in original}
+    seen = set()
+    for item in edited:
+        if key not in item or item[key] not in originals:
+            diff.added.append(item)
+            continue
+        seen.add(item[key])
+        if canonical(item) == canonical(originals[item[key]]):
+            diff.unchanged.append(item)
+        else:
+            diff.modified.append(item)
+
+    diff.deleted = [item for item_key, item in originals.items() if item_key not in seen]
+    return diff
+
+
 # Open in editor for error check
 def open_in_editor(filename: str):
     if os.name == 'posix':  # For macOS/Linux
@@ -113,17 +208,55 @@ def open_in_editor(filename: str):
         subprocess.run(['notepad', filename])
 
 
-def check_for_errors(data: list[dict]):
-    write_to_file(TEMP_FILE, data)
+# Load the edited file, letting the user fix it and try again while it has errors
+def load_until_valid(load, filename: str, *args) -> list[dict]:
+    while True:
+        try:
+            return load(filename, *args)
+        except ParseError as e:
+            print(f"Could not read the edited file: {e}")
+            input("Fix the file and press enter to try again...")
+
+
+# Split records into those to show in the editor and those passed on untouched
+# Everything is shown unless only_uncertain is set in the config
+def split_review(data: list[dict], only: Callable[[dict], bool] = None) -> (list[dict], list[dict]):
+    if only is None or not config.getboolean("REVIEW", "only_uncertain", fallback=False):
+        return data, []
+    shown, hidden = [], []
+    for entry in data:
+        (shown if only(entry) else hidden).append(entry)
+    return shown, hidden
+
+
+# `only` picks the uncertain records, e.g. unknown labels, when only those should be reviewed
+def check_for_errors(data: list[dict], only: Callable[[dict], bool] = None) -> list[dict]:
+    shown, hidden = split_review(data, only)
+    if not shown:
+        return hidden
+
+    write_to_file(TEMP_FILE, shown)
+
+    with span("review editor") as current:
+        current.items = len(shown)
+        open_in_editor(TEMP_FILE)
+        reviewed = load_until_valid(load_from_file, TEMP_FILE)
 
-    open_in_editor(TEMP_FILE)
+    return reviewed + hidden
 
-    return load_from_file(TEMP_FILE)
 
+# `only` picks the uncertain headers with their entries, e.g. unknown locations, when only those should be reviewed
+def check_for_errors_with_header(data: list[dict], header_name, entry_name,
+                                 only: Callable[[dict], bool] = None) -> list[dict]:
+    shown, hidden = split_review(data, only)
+    if not shown:
+        return hidden
 
-def check_for_errors_with_header(data: list[dict], header_name, entry_name) -> list[dict]:
-    write_to_file_with_header(TEMP_FILE, data, header_name, entry_name)
+    write_to_file_with_header(TEMP_FILE, shown, header_name, entry_name)
 
-    open_in_editor(TEMP_FILE)
+    with span("review editor") as current:
+        current.items = len(shown)
+        open_in_editor(TEMP_FILE)
+        reviewed = load_until_valid(load_from_file_with_header, TEMP_FILE, header_name, entry_name)
 
-    return load_from_file_with_header(TEMP_FILE, header_name, entry_name)
\ No newline at end of file
+    return reviewed + hidden
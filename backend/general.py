@@ -1,6 +1,10 @@
 import os
 import sys
+import threading
 import configparser
+from datetime import datetime
+
+from backend.locations import LocationIndex
 
 
 # Function to end program safely
@@ -9,24 +13,109 @@ def end_safely(status: int):
     sys.exit(status)
 
 
+# Parse a timestamp from Homebox
+def parse_time(timestamp: str) -> datetime:
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
 # Replace location paths with their ID's
-def translate_locations(data: list[dict], locations: list[str], loc_ids: list[str]) -> list[dict]:
+def translate_locations(data: list[dict], locations: LocationIndex) -> list[dict]:
     for dictionary in data:
         location = dictionary["location"]
-        if location in locations:
-            loc_ind = locations.index(location)
-            dictionary["location"] = loc_ids[loc_ind]
+        loc_id = locations.resolve(location)
+        if loc_id is not None:
+            dictionary["location"] = loc_id
         else:
             print(f"Location {location} not found. These items will be unaffected:")
             print(dictionary["items"])
+            suggestions = locations.suggest(location)
+            if suggestions:
+                print(f"Did you mean: {', '.join(path for path, _ in suggestions)}?")
             dictionary["items"] = []
 
     return data
 
 
+# Replace unknown location paths with a close enough known path, so the fix shows up in the review
+def fix_locations(data: list[dict], locations: LocationIndex) -> list[dict]:
+    cutoff = config.getfloat("ADDER", "location_match_cutoff", fallback=0.85)
+    for dictionary in data:
+        location = dictionary["location"]
+        if locations.resolve(location) is not None:
+            continue
+        suggestions = locations.suggest(location, n=1, cutoff=cutoff)
+        if suggestions:
+            print(f"Location {location} not found, using closest match {suggestions[0][0]}.")
+            dictionary["location"] = suggestions[0][0]
+
+    return data
+
+
 project_root = os.path.abspath(os.path.dirname(__file__))
 
 config_path = os.path.join(project_root, '../config.ini')
 
-config = configparser.ConfigParser()
-config.read(config_path)
\ No newline at end of file
+# config.ini is only read when the first setting is used, so importing a module costs nothing until then
+class LazyConfig(configparser.ConfigParser):
+    def __init__(self, path: str):
+        self.path = path
+        self.loaded = False
+        self.reading = False
+        self.lock = threading.RLock()
+        super().__init__()
+
+    # Worker threads may use the config first, so others wait until the whole file is read
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded or self.reading:  # reading: a lookup made by read() itself
+                return
+            self.reading = True
+            try:
+                self.read(self.path)
+            finally:
+                self.reading = False
+            self.loaded = True
+
+    def get(self, section, option, **kwargs):
+        self.load()
+        return super().get(section, option, **kwargs)
+
+    def set(self, section, option, value=None):
+        self.load()
+        super().set(section, option, value)
+
+    def sections(self):
+        self.load()
+        return super().sections()
+
+    def has_section(self, section):
+        self.load()
+        return super().has_section(section)
+
+    def has_option(self, section, option):
+        self.load()
+        return super().has_option(section, option)
+
+    def items(self, *args, **kwargs):
+        self.load()
+        return super().items(*args, **kwargs)
+
+    def __getitem__(self, key):
+        self.load()
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.load()
+        return super().__contains__(key)
+
+
+config = LazyConfig(config_path)
+
+
+# Override a config setting for this run only, e.g. from a command line flag
+def override_config(section: str, option: str, value):
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, option, str(value))
@@ -1,26 +1,134 @@
+from backend.general import config
+
 import os
-from google import genai
-from google.genai.types import GenerateContentResponse
-from pydantic import BaseModel
+import time
+import asyncio
+import threading
+from typing import Callable, TYPE_CHECKING
 
+# The Gemini SDK takes most of a second to import, so it is only imported when the first request is made
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai.types import GenerateContentResponse
 
-# Process AI response to structure recognized items and locations
-def get_response(prompt: str, llm_config: dict = None) -> GenerateContentResponse:
+_client: "genai.Client | None" = None
+_client_lock = threading.Lock()
+
+# Event loop running in a background thread, so the async client always lives on the same loop
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+# Functions called with token usage and latency after every LLM call
+usage_hooks: list[Callable[[dict], None]] = []
+
+
+# Shared Gemini client, created on first use
+def get_client() -> "genai.Client":
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google import genai
+            _client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return _client
+
+
+def get_model() -> str:
+    return config.get("LLM", "model", fallback="gemini-2.0-flash")
+
+
+def add_usage_hook(hook: Callable[[dict], None]):
+    usage_hooks.append(hook)
+
+
+def record_usage(response: "GenerateContentResponse", model: str, latency: float):
+    if not usage_hooks:
+        return
+    usage = response.usage_metadata
+    record = {
+        "model": model,
+        "latency": latency,
+        "prompt_tokens": usage.prompt_token_count if usage else None,
+        "output_tokens": usage.candidates_token_count if usage else None,
+        "total_tokens": usage.total_token_count if usage else None
+    }
+    for hook in usage_hooks:
+        hook(record)
+
+
+def default_llm_config(llm_config: dict = None) -> dict:
     if llm_config is None:
         llm_config = {
             "response_mime_type": "application/json"
         }
+    return llm_config
 
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
+# Process AI response to structure recognized items and locations
+def get_response(prompt: str, llm_config: dict = None) -> "GenerateContentResponse":
+    model = get_model()
+
+    start = time.perf_counter()
+    response = get_client().models.generate_content(
+        model=model,
         contents=prompt,
-        config=llm_config
+        config=default_llm_config(llm_config)
     )
+    record_usage(response, model, time.perf_counter() - start)
 
     return response
 
 
 def get_parsed_list(prompt: str, llm_config: dict = None) -> list[dict]:
-    return [item.model_dump() for item in get_response(prompt, llm_config).parsed]
\ No newline at end of file
+    return [item.model_dump() for item in get_response(prompt, llm_config).parsed]
+
+
+async def get_response_async(prompt: str, llm_config: dict = None) -> "GenerateContentResponse":
+    model = get_model()
+
+    start = time.perf_counter()
+    response = await get_client().aio.models.generate_content(
+        model=model,
+        contents=prompt,
+        config=default_llm_config(llm_config)
+    )
+    record_usage(response, model, time.perf_counter() - start)
+
+    return response
+
+
+async def get_parsed_list_async(prompt: str, llm_config: dict = None) -> list[dict]:
+    response = await get_response_async(prompt, llm_config)
+    return [item.model_dump() for item in response.parsed]
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return _loop
+
+
+# Run many prompts at once, with at most max_concurrency requests in flight
+# Results are in prompt order, a prompt that failed holds its exception instead of a list
+def get_parsed_lists_batch(prompts: list[str], llm_config: dict = None,
+                           max_concurrency: int = None) -> list[list[dict] | Exception]:
+    if max_concurrency is None:
+        max_concurrency = config.getint("LLM", "max_concurrency", fallback=4)
+
+    async def run_all() -> list:
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run_one(prompt: str) -> list[dict]:
+            async with semaphore:
+                return await get_parsed_list_async(prompt, llm_config)
+
+        return await asyncio.gather(*(run_one(prompt) for prompt in prompts), return_exceptions=True)
+
+    return asyncio.run_coroutine_threadsafe(run_all(), get_event_loop()).result()
+
+
+# Rough token count of a text, about four characters per token
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
@@ -0,0 +1,150 @@
+import sys
+import difflib
+from array import array
+from bisect import bisect_left
+
+
+# Lowercase, collapse whitespace and drop spaces around slashes, so small LLM differences still match
+def normalize_path(path: str) -> str:
+    return "/".join(" ".join(part.lower().split()) for part in path.split("/"))
+
+
+# Path hash of a location, combining its parent's hash (0 for top level) with its name
+def path_hash(parent_hash: int, name: str) -> int:
+    return hash((parent_hash, name))
+
+
+# Lookup structure for Homebox locations, by full path and by ID
+# Locations are stored in flat arrays, each one pointing to its parent by position (-1 for top level)
+# Full paths are not stored, they are built from the names when needed
+class LocationIndex:
+    def __init__(self):
+        self.ids: list[str] = []
+        self.names: list[str] = []
+        self.parent_index = array("i")
+        self.id_to_index: dict[str, int] = {}
+        self._hashes: tuple[array, array] | None = None
+        self._normalized: dict[str, int] | None = None
+        self._children: dict[int, list[int]] | None = None
+
+    # Add a whole location tree, walking it with a stack instead of recursion
+    # Locations are added parents first, in the same order as the tree
+    def add_tree(self, node: dict, parent: int = -1):
+        ids, names, parents, id_to_index = self.ids, self.names, self.parent_index, self.id_to_index
+        intern = sys.intern
+
+        stack = [(node, parent)]
+        while stack:
+            current, current_parent = stack.pop()
+            index = len(ids)
+            ids.append(current["id"])
+            names.append(intern(current["name"]))
+            parents.append(current_parent)
+            id_to_index[current["id"]] = index
+
+            children = current["children"]
+            if children:
+                stack.extend((child, index) for child in reversed(children))
+
+        self._hashes = None
+        self._normalized = None
+        self._children = None
+
+    # Full path of the location at a position
+    def path_at(self, index: int) -> str:
+        parts = []
+        while index >= 0:
+            parts.append(self.names[index])
+            index = self.parent_index[index]
+        return "/".join(reversed(parts))
+
+    # All paths, in the order the locations were added, each built once from its parent's path
+    @property
+    def paths(self) -> list[str]:
+        paths = []
+        for index, parent in enumerate(self.parent_index):
+            name = self.names[index]
+            paths.append(name if parent < 0 else f"{paths[parent]}/{name}")
+        return paths
+
+    # Sorted path hashes and the position of each, for exact lookups without a dict of every path
+    # Only built once a path is looked up
+    @property
+    def hashes(self) -> tuple[array, array]:
+        if self._hashes is None:
+            hashes = array("q")
+            for index, parent in enumerate(self.parent_index):
+                hashes.append(path_hash(hashes[parent] if parent >= 0 else 0, self.names[index]))
+            order = array("i", sorted(range(len(hashes)), key=hashes.__getitem__))
+            self._hashes = (array("q", (hashes[index] for index in order)), order)
+        return self._hashes
+
+    # Position of a location by its exact path, comparing the full path to rule out hash collisions
+    def find(self, path: str) -> int | None:
+        hashes, order = self.hashes
+        target = 0
+        for name in path.split("/"):
+            target = path_hash(target, name)
+        position = bisect_left(hashes, target)
+        while position < len(hashes) and hashes[position] == target:
+            if self.path_at(order[position]) == path:
+                return order[position]
+            position += 1
+        return None
+
+    # Normalized path lookup, only built once a path is not found exactly
+    @property
+    def normalized(self) -> dict[str, int]:
+        if self._normalized is None:
+            self._normalized = {}
+            normalized_paths = []
+            for index, parent in enumerate(self.parent_index):
+                name = normalize_path(self.names[index])
+                path = name if parent < 0 else f"{normalized_paths[parent]}/{name}"
+                normalized_paths.append(path)
+                self._normalized.setdefault(path, index)
+        return self._normalized
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, path: str) -> bool:
+        return self.resolve(path) is not None
+
+    def path_of(self, loc_id: str) -> str | None:
+        index = self.id_to_index.get(loc_id)
+        return None if index is None else self.path_at(index)
+
+    def parent_of(self, loc_id: str) -> str | None:
+        parent = self.parent_index[self.id_to_index[loc_id]]
+        return None if parent < 0 else self.ids[parent]
+
+    def children_of(self, loc_id: str) -> list[str]:
+        if self._children is None:
+            self._children = {}
+            for index, parent in enumerate(self.parent_index):
+                self._children.setdefault(parent, []).append(index)
+        return [self.ids[child] for child in self._children.get(self.id_to_index[loc_id], [])]
+
+    # ID of a location path, trying the exact path first and then the normalized one
+    def resolve(self, path: str) -> str | None:
+        index = self.find(path)
+        if index is None:
+            index = self.normalized.get(normalize_path(path))
+        return None if index is None else self.ids[index]
+
+    # Closest known paths to an unknown one, best match first, with their similarity from 0 to 1
+    def suggest(self, path: str, n: int = 3, cutoff: float = 0.6) -> list[tuple[str, float]]:
+        target = normalize_path(path)
+        matcher = difflib.SequenceMatcher(b=target, autojunk=False)
+        scored = []
+        for normalized, index in self.normalized.items():
+            matcher.set_seq1(normalized)
+            if matcher.real_quick_ratio() < cutoff or matcher.quick_ratio() < cutoff:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= cutoff:
+                scored.append((self.path_at(index), ratio))
+
+        scored.sort(key=lambda match: match[1], reverse=True)
+        return scored[:n]
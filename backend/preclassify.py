@@ -0,0 +1,193 @@
+from backend.general import config, project_root
+
+import os
+import math
+import heapq
+import pickle
+from itertools import islice
+from collections import Counter
+from typing import Iterable, Iterator
+
+INDEX_VERSION = 2
+
+# Terms in at most this many items are used to find candidate matches
+CANDIDATE_LIMIT = 200
+
+# Rarer terms stop adding candidates once this many are found, only the best few neighbours are kept anyway
+CANDIDATES = 50
+
+# Cached norms are recomputed once this share of the index has been added or removed since they were cleared
+NORM_DRIFT = 0.1
+
+
+# Words of a name, plus the three letter pieces of each word so small spelling differences still match
+def tokenize(text: str) -> Counter:
+    terms = Counter()
+    for word in "".join(c if c.isalnum() else " " for c in text.lower()).split():
+        terms[f"w:{word}"] += 1
+        padded = f" {word} "
+        for start in range(len(padded) - 2):
+            terms[padded[start:start + 3]] += 1
+    return terms
+
+
+# TF-IDF similarity search over the names of items that already have labels
+# Items with a close enough match get that match's labels without asking the LLM
+class PreClassifier:
+    def __init__(self, path: str = None, threshold: float = None, neighbours: int = None):
+        if path is None:
+            path = os.path.join(project_root, "..", config.get("PRECLASSIFIER", "path", fallback="preclassifier.pickle"))
+        if threshold is None:
+            threshold = config.getfloat("PRECLASSIFIER", "threshold", fallback=0.9)
+        if neighbours is None:
+            neighbours = config.getint("PRECLASSIFIER", "neighbours", fallback=5)
+        self.path = path
+        self.threshold = threshold
+        self.neighbours = neighbours
+
+        self.docs: dict[str, dict] = {}              # Item ID -> updatedAt, label IDs and term counts
+        self.df: Counter = Counter()                  # Term -> number of items containing it
+        self.postings: dict[str, dict[str, int]] = {}  # Term -> item ID -> count
+        self.norms: dict[str, float] = {}             # Item ID -> norm with the IDF of when it was cached
+        self.changes = 0                              # Items added or removed since the norms were cleared
+        self.queries = 0
+        self.hits = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as file:
+                saved = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        if saved.get("version") == INDEX_VERSION:
+            self.docs, self.df, self.postings = saved["docs"], saved["df"], saved["postings"]
+
+    def save(self):
+        with open(self.path + ".tmp", 'wb') as file:
+            pickle.dump({"version": INDEX_VERSION, "docs": self.docs, "df": self.df, "postings": self.postings}, file)
+        os.replace(self.path + ".tmp", self.path)
+
+    def idf(self, term: str) -> float:
+        return math.log((1 + len(self.docs)) / (1 + self.df.get(term, 0))) + 1
+
+    # Length of an item's TF-IDF vector, which changes with the IDF as items are added or removed
+    # Norms are cached until the index has changed by NORM_DRIFT, scores are clamped to 1 in between
+    def norm(self, item_id: str) -> float:
+        if self.changes > NORM_DRIFT * len(self.docs):
+            self.norms.clear()
+            self.changes = 0
+        norm = self.norms.get(item_id)
+        if norm is None:
+            terms = self.docs[item_id]["terms"]
+            norm = math.sqrt(sum((count * self.idf(term)) ** 2 for term, count in terms.items())) or 1
+            self.norms[item_id] = norm
+        return norm
+
+    def remove(self, item_id: str):
+        doc = self.docs.pop(item_id, None)
+        if doc is None:
+            return
+        self.norms.pop(item_id, None)
+        self.changes += 1
+        for term in doc["terms"]:
+            self.df[term] -= 1
+            postings = self.postings[term]
+            del postings[item_id]
+            if not postings:
+                del self.postings[term]
+                del self.df[term]
+
+    # Add or refresh a labeled item, items without labels are removed from the index
+    def add(self, item: dict):
+        doc = self.docs.get(item["id"])
+        if doc is not None and doc["updated"] == item.get("updatedAt"):
+            return
+        self.remove(item["id"])
+        if not item.get("labels"):
+            return
+
+        terms = tokenize(item["name"])
+        self.changes += 1
+        for term, count in terms.items():
+            self.df[term] += 1
+            self.postings.setdefault(term, {})[item["id"]] = count
+        self.docs[item["id"]] = {
+            "updated": item.get("updatedAt"),
+            "labels": [label["id"] for label in item["labels"]],
+            "terms": terms
+        }
+
+    # Keep the index up to date with items as they stream past
+    def observe(self, items: Iterable[dict]) -> Iterator[dict]:
+        for item in items:
+            self.add(item)
+            yield item
+
+    # Most similar labeled items to a name, as (item ID, cosine similarity), best first
+    def nearest(self, name: str, exclude: str = None) -> list[tuple[str, float]]:
+        weights = {term: count * self.idf(term) for term, count in tokenize(name).items()}
+        query_norm = math.sqrt(sum(weight ** 2 for weight in weights.values())) or 1
+
+        known = [term for term in weights if term in self.postings]
+        if not known:
+            return []
+
+        # Candidates come from the rarest terms first, common terms like "box" would touch most of the index
+        # Every candidate is then scored on all terms, so the similarities themselves are exact
+        known.sort(key=self.df.get)
+        candidates = set()
+        if self.df[known[0]] <= CANDIDATE_LIMIT:
+            for term in known:
+                if self.df[term] > CANDIDATE_LIMIT or len(candidates) >= CANDIDATES:
+                    break
+                candidates.update(self.postings[term])
+        else:  # Only common terms, so the items containing all of them are the candidates
+            first, rest = self.postings[known[0]], [self.postings[term] for term in known[1:]]
+            candidates.update(islice((item_id for item_id in first if all(item_id in postings for postings in rest)),
+                                     CANDIDATES + 1))
+        candidates.discard(exclude)
+
+        query = [(term, weights[term] * self.idf(term)) for term in known]
+        scored = []
+        for item_id in candidates:
+            terms = self.docs[item_id]["terms"]
+            score = sum(weight * terms[term] for term, weight in query if term in terms)
+            scored.append((item_id, min(1.0, score / (query_norm * self.norm(item_id)))))
+
+        return heapq.nlargest(self.neighbours, scored, key=lambda match: match[1])
+
+    # Label names for an item if its close matches agree, otherwise None
+    def classify(self, item: dict, labels_by_id: dict) -> list[str] | None:
+        matches = [(item_id, score) for item_id, score in self.nearest(item["name"], exclude=item["id"])
+                   if score >= self.threshold]
+        if not matches:
+            return None
+
+        votes = Counter()
+        for item_id, score in matches:
+            for label_id in self.docs[item_id]["labels"]:
+                votes[label_id] += score
+        total = sum(score for _, score in matches)
+        chosen = [labels_by_id[label_id]["name"] for label_id, vote in votes.items()
+                  if vote * 2 > total and label_id in labels_by_id]
+        return chosen or None
+
+    # Pass on items that need the LLM, collecting confident answers for the others in hits
+    def filter(self, items: Iterable[dict], labels: dict, hits: list[dict]) -> Iterator[dict]:
+        labels_by_id = {label["id"]: label for label in labels.values()}
+        for item in items:
+            self.queries += 1
+            chosen = self.classify(item, labels_by_id)
+            if chosen is None:
+                yield item
+            else:
+                self.hits += 1
+                hits.append({"id": item["id"], "labels": chosen})
+
+    def report(self):
+        rate = self.hits / self.queries * 100 if self.queries else 0
+        print(f"Pre-classifier labeled {self.hits} of {self.queries} items ({rate:.0f}% hit rate, "
+              f"threshold {self.threshold}, {len(self.docs)} labeled items indexed).")
@@ -0,0 +1,122 @@
+from backend.general import config, project_root, parse_time
+from backend.api_access import iter_items, get_item_count
+
+import os
+import json
+import time
+import threading
+from typing import Any, Callable, Iterator
+
+
+# Local copy of locations, labels and items from the last run, so startup does not wait for Homebox
+# Snapshots older than ttl_minutes, or all of them when force_resync is set, are fetched from scratch
+class SnapshotStore:
+    def __init__(self, auth_key: str, force_resync: bool = False):
+        self.auth_key = auth_key
+        self.enabled = config.getboolean("SNAPSHOT", "enabled", fallback=True)
+        self.folder = os.path.join(project_root, "..", config.get("SNAPSHOT", "path", fallback="snapshots"))
+        self.ttl = config.getfloat("SNAPSHOT", "ttl_minutes", fallback=60) * 60
+        self.refresh_wait = config.getfloat("SNAPSHOT", "refresh_wait", fallback=5)
+        self.force_resync = force_resync or config.getboolean("SNAPSHOT", "force_resync", fallback=False)
+        self.data: dict[str, Any] = {}
+        self.errors: dict[str, Exception] = {}
+        self.refreshes: dict[str, threading.Thread] = {}
+
+    def load(self, kind: str) -> dict | None:
+        filename = os.path.join(self.folder, f"{kind}.json")
+        if not self.enabled or self.force_resync or not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'r') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - snapshot.get("full_sync", snapshot["fetched"]) > self.ttl:
+            return None
+        return snapshot
+
+    def save(self, kind: str, data: Any, **extra):
+        if not self.enabled:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        filename = os.path.join(self.folder, f"{kind}.json")
+        with open(filename + ".tmp", 'w') as file:
+            json.dump({"fetched": time.time(), "data": data, **extra}, file)
+        os.replace(filename + ".tmp", filename)  # Never leave a half written snapshot behind
+
+    # Start fetching fresh data in the background, while the snapshot is used for anything needed right away
+    def refresh(self, kind: str, fetch: Callable[[str], Any]):
+        snapshot = self.load(kind)
+        if snapshot is not None:
+            self.data[kind] = snapshot["data"]
+
+        def run():
+            try:
+                data = fetch(self.auth_key)
+            except Exception as e:
+                self.errors[kind] = e
+                return
+            self.data[kind] = data
+            self.save(kind, data)
+
+        thread = threading.Thread(target=run, name=f"snapshot-{kind}", daemon=True)
+        thread.start()
+        self.refreshes[kind] = thread
+
+    # Newest data available, waiting a little for the background refresh if there is a snapshot to fall back on
+    def latest(self, kind: str) -> Any:
+        thread = self.refreshes.get(kind)
+        if thread is not None:
+            thread.join(self.refresh_wait if kind in self.data else None)
+        if kind not in self.data:
+            raise self.errors.get(kind, RuntimeError(f"Could not get {kind} from Homebox."))
+        return self.data[kind]
+
+    # All items, only fetching those changed since the snapshot
+    # Falls back to a full fetch if items were deleted or Homebox does not order by update time
+    def items(self) -> dict:
+        return {item["id"]: item for item in self.stream_items()}
+
+    # Same as items(), but yields them as they arrive, so a full fetch does not hold up the caller
+    # The snapshot is only saved once every item has been read
+    def stream_items(self) -> Iterator[dict]:
+        snapshot = self.load("items")
+        items = self.sync_items(snapshot) if snapshot is not None else None
+
+        if items is None:
+            full_sync = time.time()
+            items = {}
+            for item in iter_items(self.auth_key):
+                items[item["id"]] = item
+                yield item
+        else:
+            full_sync = snapshot.get("full_sync", snapshot["fetched"])
+            yield from items.values()
+
+        newest = max((item["updatedAt"] for item in items.values()), key=parse_time, default=None)
+        self.save("items", items, newest=newest, full_sync=full_sync)
+        self.data["items"] = items
+
+    def sync_items(self, snapshot: dict) -> dict | None:
+        items = snapshot["data"]
+        if snapshot.get("newest") is None:
+            return None
+        since = parse_time(snapshot["newest"])
+
+        previous = None
+        stream = iter_items(self.auth_key, order_by="updatedAt", prefetch=1)
+        try:
+            for item in stream:
+                updated = parse_time(item["updatedAt"])
+                if previous is not None and updated > previous:
+                    return None
+                previous = updated
+                if updated < since:
+                    break
+                items[item["id"]] = item
+        finally:
+            stream.close()
+
+        if len(items) != get_item_count(self.auth_key):
+            return None
+        return items
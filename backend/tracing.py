@@ -0,0 +1,152 @@
+from backend.general import config, project_root
+
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterator
+
+# Homebox IDs in a path are replaced, so every item shares one entry in the report
+ID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+# Something measured inside a span, set by the code being timed
+@dataclass(slots=True)
+class Span:
+    name: str
+    items: int = 0
+    bytes: int = 0
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Timings of named stages and calls for one run, safe to use from several threads
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    # Read on use, so importing a backend module does not load config.ini and overrides still apply
+    @property
+    def enabled(self) -> bool:
+        return config.getboolean("TRACING", "enabled", fallback=True)
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.durations: dict[str, list[float]] = {}
+            self.items: Counter = Counter()
+            self.bytes: Counter = Counter()
+            self.counters: Counter = Counter()
+
+    def record(self, name: str, seconds: float, items: int = 0, nbytes: int = 0):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.durations.setdefault(name, []).append(seconds)
+            self.items[name] += items
+            self.bytes[name] += nbytes
+
+    def count(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        current = Span(name)
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            self.record(name, time.perf_counter() - start, current.items, current.bytes)
+
+    # Usage hook for backend.llm, called after every LLM request
+    def record_llm(self, usage: dict):
+        self.record(f"llm {usage['model']}", usage["latency"])
+        for key in ("prompt_tokens", "output_tokens", "total_tokens"):
+            if usage.get(key):
+                self.count(f"llm {key}", usage[key])
+
+    def report(self) -> dict:
+        with self.lock:
+            spans = {}
+            for name, durations in self.durations.items():
+                ordered = sorted(durations)
+                spans[name] = {
+                    "calls": len(ordered),
+                    "total_s": round(sum(ordered), 4),
+                    "mean_s": round(sum(ordered) / len(ordered), 4),
+                    "p50_s": round(percentile(ordered, 0.5), 4),
+                    "p90_s": round(percentile(ordered, 0.9), 4),
+                    "p99_s": round(percentile(ordered, 0.99), 4),
+                    "max_s": round(ordered[-1], 4),
+                    "items": self.items[name],
+                    "bytes": self.bytes[name]
+                }
+            return {"started": self.started, "wall_s": round(time.time() - self.started, 4),
+                    "spans": spans, "counters": dict(self.counters)}
+
+
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
+
+
+def homebox_route(method: str, path: str) -> str:
+    return f"homebox {method} {ID_PATTERN.sub('{id}', path.split('?')[0])}"
+
+
+def report_folder() -> str:
+    return os.path.join(project_root, "..", config.get("TRACING", "report_path", fallback="reports"))
+
+
+def print_summary(report: dict, top: int = 8):
+    spans = sorted(report["spans"].items(), key=lambda entry: entry[1]["total_s"], reverse=True)[:top]
+    print(f"Run took {report['wall_s']:.1f}s, slowest stages:")
+    for name, stats in spans:
+        print(f"  {name:<40} {stats['total_s']:8.2f}s  {stats['calls']:6} calls  p90 {stats['p90_s']:.3f}s")
+
+
+# Trace a whole run, writing a JSON report and, if asked for, a cProfile dump to the report folder
+@contextmanager
+def traced_run(name: str, profile: bool = False) -> Iterator[Tracer]:
+    from backend.llm import add_usage_hook, usage_hooks
+    if tracer.record_llm not in usage_hooks:
+        add_usage_hook(tracer.record_llm)
+
+    tracer.reset()
+    profile = profile or config.getboolean("TRACING", "profile", fallback=False)
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield tracer
+    finally:
+        if profiler:
+            profiler.disable()
+        if tracer.enabled or profiler:
+            folder = report_folder()
+            os.makedirs(folder, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            if tracer.enabled:
+                report = tracer.report()
+                filename = os.path.join(folder, f"{name}-{stamp}.json")
+                with open(filename, 'w') as file:
+                    json.dump(report, file, indent=2)
+                print_summary(report)
+                print(f"Run report written to {filename}")
+            if profiler:
+                filename = os.path.join(folder, f"{name}-{stamp}.prof")
+                profiler.dump_stats(filename)
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+                print(f"Profile written to {filename}, open it with e.g. snakeviz or pstats")
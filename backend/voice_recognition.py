@@ -1,49 +1,235 @@
 from backend.general import config, end_safely
+from backend.cache import ResultCache, make_key
+from backend.tracing import span, count
 
+import io
 import os
-import sys
 import re
-import speech_recognition as sr
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError
+import wave
+import hashlib
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, TYPE_CHECKING
 
+# Speech recognition and pydub are slow to import, so they are only imported once audio is handled
+if TYPE_CHECKING:
+    import speech_recognition as sr
+    from pydub import AudioSegment
 
-def convert_sound_file(filename: str) -> str:
+
+# Hash of a file's content, read in blocks
+def file_hash(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Decode any FFMPEG supported file straight into an in-memory mono WAV at the recognizer's sample rate
+def ffmpeg_to_wav(filename: str, sample_rate: int) -> io.BytesIO:
+    from pydub.exceptions import CouldntDecodeError
+    from pydub.utils import get_encoder_name
+
+    command = [get_encoder_name(), "-v", "error", "-i", filename,
+               "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-acodec", "pcm_s16le", "-"]
+    with span("ffmpeg convert") as current:
+        res = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        current.bytes = len(res.stdout)
+    if res.returncode != 0:
+        raise CouldntDecodeError(res.stderr.decode(errors="replace"))
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(res.stdout)
+    buffer.seek(0)
+    return buffer
+
+
+# Keep converted files in the conversions folder under their content hash, removing the oldest above the size limit
+def cached_conversion(filename: str, sample_rate: int, limit_mb: float) -> io.BytesIO:
+    os.makedirs("conversions", exist_ok=True)
+    cached_name = os.path.join("conversions", f"{file_hash(filename)}_{sample_rate}.wav")
+    if os.path.exists(cached_name):
+        os.utime(cached_name)  # Mark as recently used
+        with open(cached_name, 'rb') as file:
+            return io.BytesIO(file.read())
+
+    buffer = ffmpeg_to_wav(filename, sample_rate)
+    with open(cached_name, 'wb') as file:
+        file.write(buffer.getbuffer())
+
+    cached = sorted((entry for entry in os.scandir("conversions") if entry.is_file()),
+                    key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in cached)
+    for entry in cached:
+        if total <= limit_mb * 1e6 or entry.path == cached_name:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+    return buffer
+
+
+# Returns the file itself if it is already readable, otherwise the converted audio in memory
+# Raises ValueError if the file cannot be converted
+def convert_sound_file(filename: str) -> str | io.BytesIO:
     pattern = r"([^\\/]+)\.([^\\/]+)$"
     matches = re.search(pattern, filename)
-    converted_name = ""
     if not matches:  # Regex not matching a file with file extension
-        print("Faulty file path, does this lead to a file with a valid name and file extension?")
-        sys.exit(1)
+        raise ValueError("Faulty file path, does this lead to a file with a valid name and file extension?")
     if matches[2].lower() in ["wav", "aiff", "aif", "aifc", "flac"]:  # No need to convert when already readable
         return filename
     else:
-        if not os.path.exists("conversions"):  # Creates conversions folder if not there
-            os.makedirs("conversions")
-        try:  # Tries to convert with FFMPEG and file extension
-            converted_name = f"conversions/conv_{matches[1]}.wav"
-            audio_segment = AudioSegment.from_file(filename, format=matches[2])
-            audio_segment.export(converted_name, format="wav")
-        except CouldntDecodeError:  # If file extension is not convertable by FFMPEG
-            print("Could not decode file. Is file an audio file, and is the file type supported by FFMPEG?")
-            end_safely(1)
-        except RuntimeWarning:
-            print("Could not find FFMPEG. Make sure to install it if you wish to use the attempt_conversion option!")
-            end_safely(1)
-        return converted_name
-
-
-# Convert audio file into text using speech recognition
-def interpret_sound_file(filename: str) -> str:
+        from pydub.exceptions import CouldntDecodeError
+        sample_rate = config.getint("VOICE_RECOGNITION", "sample_rate", fallback=16000)
+        cache_mb = config.getfloat("VOICE_RECOGNITION", "conversion_cache_mb", fallback=0)
+        try:  # Tries to convert with FFMPEG
+            if cache_mb > 0:
+                return cached_conversion(filename, sample_rate, cache_mb)
+            return ffmpeg_to_wav(filename, sample_rate)
+        except CouldntDecodeError as e:  # If file is not convertable by FFMPEG
+            raise ValueError("Could not decode file. Is file an audio file, and is the file type supported by FFMPEG?") from e
+        except FileNotFoundError as e:
+            raise ValueError("Could not find FFMPEG. Make sure to install it if you wish to use the attempt_conversion option!") from e
+
+
+# Speech recognition engines, each taking a Recognizer and the audio and returning the text
+# Register another one, e.g. an offline engine, and select it with the recognizer setting
+RECOGNIZERS: dict[str, Callable[["sr.Recognizer", "sr.AudioData"], str]] = {
+    "google": lambda recognizer, audio: recognizer.recognize_google(audio),
+    "sphinx": lambda recognizer, audio: recognizer.recognize_sphinx(audio),
+}
+
+
+def register_recognizer(name: str, recognize: Callable[["sr.Recognizer", "sr.AudioData"], str]):
+    RECOGNIZERS[name] = recognize
+
+
+def recognize_segment(segment: "AudioSegment") -> str:
+    import speech_recognition as sr
+
+    name = config.get("VOICE_RECOGNITION", "recognizer", fallback="google")
+    audio = sr.AudioData(segment.raw_data, segment.frame_rate, segment.sample_width)
+    with span(f"recognize {name}") as current:
+        current.bytes = len(segment.raw_data)
+        try:
+            return RECOGNIZERS[name](sr.Recognizer(), audio)
+        except sr.UnknownValueError:  # Nothing understandable in this segment
+            return ""
+
+
+# Where to cut a piece of audio, preferring the middle of the last silence before max_ms
+def find_cut(audio: "AudioSegment", max_ms: int, min_silence_ms: int, silence_offset: float) -> int:
+    from pydub.silence import detect_silence
+
+    silences = detect_silence(audio[:max_ms], min_silence_len=min_silence_ms,
+                              silence_thresh=audio.dBFS - silence_offset)
+    for start, end in reversed(silences):
+        if start > 0:
+            return (start + end) // 2
+    return max_ms
+
+
+# Read an audio file a block at a time and cut it into segments of at most max_seconds, on silences where possible
+# Only about two blocks of audio are held in memory at once
+def iter_segments(filename: str | io.BytesIO) -> Iterator["AudioSegment"]:
+    import speech_recognition as sr
+    from pydub import AudioSegment
+    from pydub.silence import detect_nonsilent
+
+    max_ms = int(config.getfloat("VOICE_RECOGNITION", "segment_seconds", fallback=30) * 1000)
+    min_silence_ms = config.getint("VOICE_RECOGNITION", "min_silence_ms", fallback=400)
+    silence_offset = config.getfloat("VOICE_RECOGNITION", "silence_offset_db", fallback=16)
+    sample_rate = config.getint("VOICE_RECOGNITION", "sample_rate", fallback=16000)
+
+    r = sr.Recognizer()
+    with sr.AudioFile(filename) as source:
+        carry = AudioSegment.empty()
+        finished = False
+        while not finished:
+            block = r.record(source, duration=max_ms / 1000)
+            finished = len(block.frame_data) == 0
+            audio = AudioSegment(block.frame_data, sample_width=block.sample_width,
+                                 frame_rate=block.sample_rate, channels=1)
+            if audio.frame_rate > sample_rate:  # Smaller upload, with no loss for speech
+                audio = audio.set_frame_rate(sample_rate)
+            carry += audio
+
+            while len(carry) > max_ms or (finished and len(carry) > 0):
+                cut = find_cut(carry, max_ms, min_silence_ms, silence_offset) if len(carry) > max_ms else len(carry)
+                segment, carry = carry[:cut], carry[cut:]
+                if detect_nonsilent(segment, min_silence_len=min_silence_ms,
+                                    silence_thresh=segment.dBFS - silence_offset):
+                    yield segment
+
+
+# Transcribe an audio file segment by segment, several segments at a time
+# Text is yielded in the order it was spoken, as soon as each segment and those before it are done
+def iter_transcript(filename: str | io.BytesIO) -> Iterator[str]:
+    workers = config.getint("VOICE_RECOGNITION", "transcription_workers", fallback=4)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = deque()
+        for segment in iter_segments(filename):
+            pending.append(pool.submit(recognize_segment, segment))
+            while pending and (pending[0].done() or len(pending) > workers * 2):
+                text = pending.popleft().result()
+                if text:
+                    yield text
+        while pending:
+            text = pending.popleft().result()
+            if text:
+                yield text
+
+
+# Settings that change what text comes out of a recording
+def recognizer_settings() -> dict:
+    options = ["attempt_conversion", "recognizer", "sample_rate", "segment_seconds", "min_silence_ms", "silence_offset_db"]
+    return {option: config.get("VOICE_RECOGNITION", option, fallback=None) for option in options}
+
+
+def transcript_cache() -> ResultCache | None:
+    if config.getboolean("CACHE", "enabled", fallback=True) and config.getboolean("CACHE", "transcripts", fallback=True):
+        return ResultCache("transcripts")
+    return None
+
+
+# Convert audio file into text using speech recognition, raising ValueError if the file cannot be read
+# Recordings transcribed before with the same settings are answered from the cache
+def transcribe_sound_file(filename: str) -> str:
     attempt_conversion = config.getboolean("VOICE_RECOGNITION", "attempt_conversion")
-    try:                # Try to read the audio file as PCM WAV, AIFF/AIFF-C, or Native FLAC
-        if attempt_conversion:
-            filename = convert_sound_file(filename)
-        r = sr.Recognizer()
-        with sr.AudioFile(filename) as source:
-            audio_data = r.record(source)
-            text = r.recognize_google(audio_data)
+    cache = transcript_cache()
+    key = make_key(file_hash(filename), recognizer_settings()) if cache else None
+    if cache:
+        text = cache.get(key)
+        if text is not None:
+            cache.close()
+            count("transcript cache hits")
             return text
+
+    # Try to read the audio file as PCM WAV, AIFF/AIFF-C, or Native FLAC
+    if attempt_conversion:
+        filename = convert_sound_file(filename)
+    try:
+        text = " ".join(iter_transcript(filename))
+    except ValueError as e:
+        raise ValueError("Audio file could not be read as PCM WAV, AIFF/AIFF-C, or Native FLAC; "
+                         "check if file is corrupted or in another format.") from e
+    if cache:
+        cache.put(key, text)
+        cache.close()
+    return text
+
+
+# Convert audio file into text, exiting the program if it cannot be read
+def interpret_sound_file(filename: str) -> str:
+    try:
+        return transcribe_sound_file(filename)
     except ValueError as e:
-        print("Audio file could not be read as PCM WAV, AIFF/AIFF-C, or Native FLAC; check if file is corrupted or in another format.")
-        end_safely(1)    # Exit program if audio file cannot be read
\ No newline at end of file
+        print(e)
+        end_safely(1)    # Exit program if audio file cannot be read
@@ -0,0 +1,97 @@
+# Throughput of reading and writing the error check file format, compared with the old readlines/findall loader
+# Run from the project folder with: python -m benchmarks.bench_error_check [items]
+
+from backend.error_check import write_to_file_with_header, load_from_file_with_header
+
+import os
+import re
+import sys
+import time
+import tempfile
+import tracemalloc
+
+LEGACY_PATTERN = r"::(\w+)::\s*(.*?)(?=\s+::|\s*$)"
+
+
+# The loader used before the streaming parser, kept here as the baseline
+def legacy_load_with_header(filename: str, header_name: str = "location", entry_name: str = "items") -> list[dict]:
+    updated_data = []
+    current_header = None
+    current_entries = []
+
+    with open(filename, 'r') as file:
+        lines = file.readlines()
+
+        for line in lines:
+            line = line.strip()
+            if "::" in line:
+                matches = re.findall(LEGACY_PATTERN, line)
+                res_dict = {}
+                for key, value in matches:
+                    if key in res_dict:
+                        if isinstance(res_dict[key], list):
+                            res_dict[key].append(value)
+                        else:
+                            res_dict[key] = [res_dict[key], value]
+                    else:
+                        res_dict[key] = value
+                current_entries.append(res_dict)
+            elif line.startswith('<') and line.endswith('>'):
+                if current_header:
+                    updated_data.append({header_name: current_header, entry_name: current_entries})
+
+                current_header = line[1:-1]
+                current_entries = []
+
+        if current_header:
+            updated_data.append({header_name: current_header, entry_name: current_entries})
+
+    return updated_data
+
+
+def make_data(items: int, per_location: int = 50) -> list[dict]:
+    data = []
+    for number in range(items):
+        if number % per_location == 0:
+            data.append({"location": f"Garage/Cabinet {number // per_location}/Drawer {number % 7}", "items": []})
+        data[-1]["items"].append({
+            "quantity": str(number % 9 + 1),
+            "name": f"Item number {number}",
+            "description": f"A short description of item {number} with a few words",
+            "labels": ["Tools", "Hardware"] if number % 3 else "Tools"
+        })
+    return data
+
+
+# Timed without tracemalloc, which slows allocation heavy code down unevenly, then run again for peak memory
+def measure(name: str, function, *args, items: int):
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<16} {elapsed:7.3f}s  {items / elapsed:10.0f} items/sec   peak memory {peak / 1e6:7.1f} MB")
+    return result
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    data = make_data(items)
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "review")
+        print(f"Error check file with {items} items:")
+        measure("write", write_to_file_with_header, filename, data, items=items)
+        print(f"  file size {os.path.getsize(filename) / 1e6:.1f} MB")
+        legacy = measure("legacy load", legacy_load_with_header, filename, items=items)
+        loaded = measure("streaming load", load_from_file_with_header, filename, items=items)
+
+    assert loaded == legacy, "Loaders disagree"
+    assert loaded == data, "Round trip changed the data"
+
+
+if __name__ == "__main__":
+    main()
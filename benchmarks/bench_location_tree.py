@@ -0,0 +1,114 @@
+# Compares the old recursive location tree flattening with the stack based LocationIndex
+# Run from the project folder with: python -m benchmarks.bench_location_tree [nodes] [branching]
+
+from backend.api_access import helper_location_tree
+from backend.locations import LocationIndex
+
+import sys
+import time
+import random
+import tracemalloc
+
+
+# The flattening used before LocationIndex, kept here as the baseline
+def legacy_location_tree(node: dict) -> (list[str], list[str]):
+    name = node["name"]
+    locations = [name]
+    ids = [node["id"]]
+    for child in node["children"]:
+        sub_locations, sub_ids = legacy_location_tree(child)
+        for s_loc in sub_locations:
+            locations.append(f"{name}/{s_loc}")
+        ids.extend(sub_ids)
+
+    return locations, ids
+
+
+def legacy_flatten(tree: list[dict]) -> (list[str], list[str]):
+    locations, ids = [], []
+    for location in tree:
+        locs, idss = legacy_location_tree(location)
+        locations.extend(locs)
+        ids.extend(idss)
+    return locations, ids
+
+
+def index_flatten(tree: list[dict]) -> LocationIndex:
+    index = LocationIndex()
+    for location in tree:
+        helper_location_tree(location, index)
+    return index
+
+
+# Synthetic tree with the given number of nodes, filled breadth first with `branching` children per node
+def make_tree(nodes: int, branching: int) -> list[dict]:
+    all_nodes = []
+    for number in range(nodes):
+        node = {"id": f"id-{number:08d}", "name": f"Location {number % 50}", "children": []}
+        if number >= branching:
+            all_nodes[(number - branching) // branching]["children"].append(node)
+        all_nodes.append(node)
+    return all_nodes[:branching]
+
+
+# Single chain of nodes, deeper than the default recursion limit
+def make_chain(depth: int) -> list[dict]:
+    root = {"id": "id-0", "name": "Location 0", "children": []}
+    node = root
+    for number in range(1, depth):
+        child = {"id": f"id-{number}", "name": f"Location {number}", "children": []}
+        node["children"].append(child)
+        node = child
+    return [root]
+
+
+def measure(name: str, function, tree: list[dict]):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        function(tree)
+        result = f"{time.perf_counter() - start:8.3f}s"
+    except RecursionError:
+        result = "RecursionError"
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<10} {result:>16}   peak memory {peak / 1e6:7.1f} MB")
+
+
+# Time looking up location IDs by path, as translate_locations does for every dictated location
+def measure_lookups(tree: list[dict], count: int = 1000):
+    legacy_paths, legacy_ids = legacy_flatten(tree)
+    index = index_flatten(tree)
+    queries = random.Random(0).choices(legacy_paths, k=count)
+
+    start = time.perf_counter()
+    for path in queries:
+        legacy_ids[legacy_paths.index(path)]
+    print(f"  {'list.index':<10} {time.perf_counter() - start:15.3f}s   for {count} lookups")
+
+    start = time.perf_counter()
+    for path in queries:
+        index.resolve(path)
+    print(f"  {'index':<10} {time.perf_counter() - start:15.3f}s   for {count} lookups")
+
+    assert index.paths == legacy_paths and index.ids == legacy_ids, "Flattened trees differ"
+
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    branching = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    tree = make_tree(nodes, branching)
+    print(f"Tree with {nodes} nodes, branching {branching}:")
+    measure("recursive", legacy_flatten, tree)
+    measure("index", index_flatten, tree)
+    measure_lookups(tree)
+
+    chain = make_chain(2000)
+    print("Chain with depth 2000:")
+    measure("recursive", legacy_flatten, chain)
+    measure("index", index_flatten, chain)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# End to end runs of the adder, labeler and CSV tool against a local fake Homebox, with stub LLM and recognizer
+# Nothing leaves the machine, so runs can be compared between changes to catch slow downs in the hot paths
+# Run from the project folder with: python -m benchmarks.bench_pipelines [--add 1000] [--label 10000] [--latency 5]
+
+from backend.general import override_config
+from backend import api_access
+from benchmarks.fake_homebox import FakeHomebox
+from benchmarks.stubs import install_llm, install_recognizer, adder_responder, labeler_responder, write_recording
+
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+
+# Point every setting that touches disk or the network at the benchmark's own folder and server
+def configure(folder: str, homebox: FakeHomebox, recognizer: str):
+    os.environ.update(HOMEBOX_URL=homebox.url, HOMEBOX_USERNAME="benchmark", HOMEBOX_PASSWORD="benchmark",
+                      GEMINI_API_KEY="benchmark")
+    settings = {
+        ("HOMEBOX", "token_file"): os.path.join(folder, "token"),
+        ("HOMEBOX", "retries"): 0,
+        ("CACHE", "enabled"): False,
+        ("SNAPSHOT", "path"): os.path.join(folder, "snapshots"),
+        ("SNAPSHOT", "force_resync"): True,
+        ("PRECLASSIFIER", "path"): os.path.join(folder, "preclassifier.pickle"),
+        ("REVIEW", "only_uncertain"): True,  # Nothing is uncertain, so the editor is never opened
+        ("ADDER", "output_into_csv"): False,
+        ("ADDER", "generate_description"): False,
+        ("VOICE_RECOGNITION", "recognizer"): recognizer,
+        ("VOICE_RECOGNITION", "attempt_conversion"): False,
+        ("TRACING", "report_path"): os.path.join(folder, "reports")
+    }
+    for (section, option), value in settings.items():
+        override_config(section, option, value)
+    api_access._client = None
+
+
+def add_scenario(homebox: FakeHomebox, folder: str, items: int, inventory: int, llm_latency: float):
+    import adder
+
+    recording = os.path.join(folder, "recording.wav")
+    write_recording(recording, seconds=20)
+
+    def setup():
+        homebox.reset(items=inventory)
+        install_llm(adder_responder(homebox.paths, items), llm_latency)
+
+    def run():
+        adder.commit_data(*adder.common_process(recording, merge_duplicates=True))
+        added = len(homebox.items) - inventory
+        assert added == items, f"Expected {items} new items, Homebox has {added}"
+
+    return setup, run
+
+
+# Half of the inventory already has labels, so the pre-classifier index is built while the rest is labeled
+def label_scenario(homebox: FakeHomebox, folder: str, items: int, llm_latency: float):
+    import labeler
+
+    index = os.path.join(folder, "preclassifier.pickle")
+
+    def setup():
+        homebox.reset(items=items * 2, labeled=0.5)
+        install_llm(labeler_responder(), llm_latency)
+        if os.path.exists(index):  # Every run builds the index from scratch, as on a first run
+            os.remove(index)
+
+    def run():
+        labeler.label_items(use_cache=False)
+        unlabeled = sum(1 for item in homebox.items.values() if not item["labels"])
+        assert unlabeled == 0, f"{unlabeled} items were left without labels"
+
+    return setup, run
+
+
+def csv_scenario(homebox: FakeHomebox, folder: str, items: int):
+    from backend.csv_io import export_items, import_items
+
+    filename = os.path.join(folder, "inventory.csv")
+
+    def setup():
+        homebox.reset(items=items)
+
+    def run():
+        auth = api_access.get_homebox_auth_key()
+        export_items(filename, auth)
+        checkpoint = import_items(filename, auth, restart=True)
+        assert checkpoint.added == items, f"Expected {items} imported items, got {checkpoint.added}"
+
+    return setup, run
+
+
+# Timed without tracemalloc, which slows allocation heavy code down unevenly, then run again for peak memory
+def measure(name: str, scenario: tuple, items: int, homebox: FakeHomebox):
+    setup, run = scenario
+    output = io.StringIO()
+
+    setup()
+    start = time.perf_counter()
+    with redirect_stdout(output):
+        run()
+    elapsed = time.perf_counter() - start
+    requests = sum(homebox.requests.values())
+
+    setup()
+    tracemalloc.start()
+    with redirect_stdout(output):
+        run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"  {name:<24} {elapsed:7.2f}s  {items / elapsed:9.0f} items/sec  {requests:7} requests   "
+          f"peak memory {peak / 1e6:7.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines against a local fake Homebox.")
+    parser.add_argument("--add", type=int, default=1000, help="items added from one recording")
+    parser.add_argument("--label", type=int, default=10000, help="unlabeled items to label")
+    parser.add_argument("--csv", type=int, default=5000, help="items exported and imported again")
+    parser.add_argument("--inventory", type=int, default=5000, help="items already in Homebox when adding")
+    parser.add_argument("--latency", type=float, default=2, help="milliseconds added to every Homebox request")
+    parser.add_argument("--llm-latency", type=float, default=200, help="milliseconds for every LLM answer")
+    parser.add_argument("--only", choices=["add", "label", "csv"], help="run a single scenario")
+    args = parser.parse_args()
+
+    homebox = FakeHomebox(items=0, latency=args.latency / 1000).start()
+    llm_latency = args.llm_latency / 1000
+
+    with tempfile.TemporaryDirectory() as folder:
+        configure(folder, homebox, install_recognizer())
+        print(f"Fake Homebox with {args.latency:g} ms latency, LLM with {args.llm_latency:g} ms latency:")
+        if args.only in (None, "add"):
+            measure(f"add {args.add} items", add_scenario(homebox, folder, args.add, args.inventory, llm_latency),
+                    args.add, homebox)
+        if args.only in (None, "label"):
+            measure(f"label {args.label} items", label_scenario(homebox, folder, args.label, llm_latency),
+                    args.label, homebox)
+        if args.only in (None, "csv"):
+            measure(f"csv round trip {args.csv}", csv_scenario(homebox, folder, args.csv), args.csv, homebox)
+
+    homebox.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+# Startup time of the command line tools, from starting Python to the first prompt or to each tool being imported
+# Run from the project folder with: python -m benchmarks.bench_startup [runs]
+
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+TARGET_MS = 200
+PROMPT = b"Which file should be processed?"
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def run_once(command: list[str], until: bytes = None) -> float:
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, *command], cwd=ROOT, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if until is None:
+        process.communicate()
+        return time.perf_counter() - start
+
+    output = b""
+    while until not in output:
+        chunk = process.stdout.read1(1024)
+        if not chunk:
+            raise RuntimeError(f"{' '.join(command)} exited before printing {until!r}")
+        output += chunk
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    return elapsed
+
+
+def measure(name: str, command: list[str], runs: int, until: bytes = None, target: bool = False):
+    run_once(command, until)  # Warm the file system cache and bytecode
+    times = [run_once(command, until) * 1000 for _ in range(runs)]
+    median = statistics.median(times)
+    verdict = ("ok" if median <= TARGET_MS else "SLOW") if target else ""
+    print(f"  {name:<28} median {median:7.1f} ms   fastest {min(times):7.1f} ms   {verdict}")
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print(f"Startup over {runs} runs, target {TARGET_MS} ms to the first prompt:")
+    measure("python itself", ["-c", "pass"], runs)
+    measure("cli.py --help", ["cli.py", "--help"], runs, target=True)
+    measure("cli.py add, to prompt", ["cli.py", "add"], runs, until=PROMPT, target=True)
+    measure("adder.py, to prompt", ["adder.py"], runs, until=PROMPT, target=True)
+    for module in ["adder", "labeler", "csv_tool", "watcher"]:
+        measure(f"import {module}", ["-c", f"import {module}"], runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# Stand-in Homebox server for benchmarks, implementing the endpoints used by backend/api_access.py
+# Everything is kept in memory, and every request can be delayed to act like a real server over the network
+
+import json
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = "Bearer benchmark-token"
+WORDS = ["Glass", "Jar", "Screw", "Hammer", "Cable", "Box", "Tape", "Drill", "Bit", "Lamp", "Battery", "Brush",
+         "Paint", "Wrench", "Nail", "Hook", "Bag", "Cup", "Plate", "Spoon", "Knife", "Charger", "Adapter", "Filter"]
+
+
+# Deterministic IDs, so runs with the same seed are comparable
+def make_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+class FakeHomebox:
+    def __init__(self, items: int = 1000, labeled: float = 0.0, rooms: int = 5, shelves: int = 4, boxes: int = 5,
+                 labels: int = 12, latency: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.reset(items, labeled, rooms, shelves, boxes, labels, seed)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-homebox", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> "FakeHomebox":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Fresh inventory, with `labeled` the share of items that already have labels
+    def reset(self, items: int = 1000, labeled: float = 0.0, rooms: int = 5, shelves: int = 4, boxes: int = 5,
+              labels: int = 12, seed: int = 1):
+        rng = random.Random(seed)
+        self.tree = []
+        self.leaves = []
+        for room in range(rooms):
+            room_node = {"id": make_id(rng), "name": f"Room {room}", "children": []}
+            for shelf in range(shelves):
+                shelf_node = {"id": make_id(rng), "name": f"Shelf {shelf}", "children": []}
+                for box in range(boxes):
+                    box_node = {"id": make_id(rng), "name": f"Box {box}", "children": []}
+                    shelf_node["children"].append(box_node)
+                    self.leaves.append((box_node, f"Room {room}/Shelf {shelf}/Box {box}"))
+                room_node["children"].append(shelf_node)
+            self.tree.append(room_node)
+
+        self.labels = [{"id": make_id(rng), "name": f"{WORDS[number % len(WORDS)]} things {number}",
+                        "description": f"Anything that is a {WORDS[number % len(WORDS)].lower()}"}
+                       for number in range(labels)]
+
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.items = {}
+        for number in range(items):
+            location, _ = self.leaves[number % len(self.leaves)]
+            item_id = make_id(rng)
+            self.items[item_id] = {
+                "id": item_id,
+                "name": f"{rng.choice(WORDS)} {rng.choice(WORDS).lower()} {number}",
+                "description": f"Benchmark item number {number}",
+                "quantity": rng.randint(1, 9),
+                "location": {"id": location["id"], "name": location["name"]},
+                "labels": [rng.choice(self.labels)] if rng.random() < labeled else [],
+                "updatedAt": (start + timedelta(seconds=number)).isoformat().replace("+00:00", "Z")
+            }
+        self.requests.clear()
+
+    @property
+    def paths(self) -> list[str]:
+        return [path for _, path in self.leaves]
+
+    def location_ref(self, location_id: str) -> dict:
+        for node, _ in self.leaves:
+            if node["id"] == location_id:
+                return {"id": node["id"], "name": node["name"]}
+        return {"id": location_id, "name": location_id}
+
+    def now(self) -> str:
+        return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    def handler(self):
+        homebox = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like a real server behind the client's connection pool
+            disable_nagle_algorithm = True  # Headers and body are written separately, do not hold the body back
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status: int, data=None):
+                body = json.dumps(data).encode() if data is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def body(self) -> dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length)) if length else {}
+
+            def route(self, method: str):
+                if homebox.latency:
+                    time.sleep(homebox.latency)
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")[2:]  # Without api/v1
+                with homebox.lock:
+                    homebox.requests[f"{method} /{parts[0]}"] += 1
+
+                if parts[:2] == ["users", "login"]:
+                    self.body()
+                    return self.reply(200, {"token": TOKEN, "expiresAt": "2099-01-01T00:00:00Z"})
+                if self.headers.get("Authorization") != TOKEN:
+                    return self.reply(401, {"error": "unauthorized"})
+                if parts[:2] == ["users", "refresh"]:
+                    return self.reply(200, {"token": TOKEN, "expiresAt": "2099-01-01T00:00:00Z"})
+                if parts == ["locations", "tree"]:
+                    return self.reply(200, homebox.tree)
+                if parts == ["labels"]:
+                    return self.reply(200, homebox.labels)
+                if parts and parts[0] == "items":
+                    return self.items(method, parts[1:], parse_qs(url.query))
+                self.reply(404, {"error": "not found"})
+
+            def items(self, method: str, rest: list[str], query: dict):
+                if method == "GET" and not rest:
+                    page = int(query.get("page", ["1"])[0])
+                    size = int(query.get("pageSize", ["50"])[0])
+                    with homebox.lock:
+                        items = list(homebox.items.values())
+                    if query.get("orderBy") == ["updatedAt"]:
+                        items.sort(key=lambda item: item["updatedAt"], reverse=True)
+                    return self.reply(200, {"items": items[(page - 1) * size:page * size], "page": page,
+                                            "pageSize": size, "total": len(items)})
+                if method == "POST" and not rest:
+                    data = self.body()
+                    item_id = str(uuid.uuid4())
+                    with homebox.lock:
+                        homebox.items[item_id] = {
+                            "id": item_id, "name": data.get("name", ""), "description": data.get("description", ""),
+                            "quantity": int(data.get("quantity") or 1),
+                            "location": homebox.location_ref(data.get("locationId")),
+                            "labels": [label for label in homebox.labels if label["id"] in data.get("labelIds", [])],
+                            "updatedAt": homebox.now()
+                        }
+                    return self.reply(201, homebox.items[item_id])
+
+                with homebox.lock:
+                    item = homebox.items.get(rest[0]) if rest else None
+                if item is None:
+                    return self.reply(404, {"error": "item not found"})
+                if method == "GET":
+                    return self.reply(200, dict(item, labels=list(item["labels"])))
+                data = self.body()
+                with homebox.lock:
+                    item.update({
+                        "name": data.get("name", item["name"]),
+                        "description": data.get("description", item["description"]),
+                        "quantity": int(data.get("quantity", item["quantity"])),
+                        "location": homebox.location_ref(data.get("locationId", item["location"]["id"])),
+                        "labels": [label for label in homebox.labels if label["id"] in data.get("labelIds", [])],
+                        "updatedAt": homebox.now()
+                    })
+                self.reply(200, item)
+
+            def do_GET(self):
+                self.route("GET")
+
+            def do_POST(self):
+                self.route("POST")
+
+            def do_PUT(self):
+                self.route("PUT")
+
+        return Handler
@@ -0,0 +1,102 @@
+# Deterministic stand-ins for Gemini and the speech recognizer, so the pipelines can be benchmarked offline
+
+from backend import llm
+from backend.voice_recognition import register_recognizer
+
+import re
+import math
+import time
+import wave
+import struct
+import asyncio
+import typing
+from types import SimpleNamespace
+from typing import Callable
+
+ITEM_ID_PATTERN = re.compile(r"ID: <([^>]+)>")
+LABEL_PATTERN = re.compile(r"<([^<>]+)> with description")
+
+
+# Answers a prompt with the list of dicts the real model would have returned
+Responder = Callable[[str], list[dict]]
+
+
+class StubModels:
+    def __init__(self, responder: Responder, latency: float):
+        self.responder = responder
+        self.latency = latency
+
+    def response(self, contents: str, config: dict) -> SimpleNamespace:
+        schema = typing.get_args(config["response_schema"])[0]
+        parsed = [schema(**answer) for answer in self.responder(contents)]
+        prompt_tokens = llm.estimate_tokens(contents)
+        output_tokens = sum(llm.estimate_tokens(str(answer)) for answer in parsed)
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                                total_token_count=prompt_tokens + output_tokens)
+        return SimpleNamespace(parsed=parsed, usage_metadata=usage)
+
+    def generate_content(self, model: str, contents: str, config: dict) -> SimpleNamespace:
+        time.sleep(self.latency)
+        return self.response(contents, config)
+
+
+class StubAsyncModels(StubModels):
+    async def generate_content(self, model: str, contents: str, config: dict) -> SimpleNamespace:
+        await asyncio.sleep(self.latency)
+        return self.response(contents, config)
+
+
+class StubClient:
+    def __init__(self, responder: Responder, latency: float = 0.0):
+        self.models = StubModels(responder, latency)
+        self.aio = SimpleNamespace(models=StubAsyncModels(responder, latency))
+
+
+# Replace the shared Gemini client, everything in backend.llm above it runs as normal
+def install_llm(responder: Responder, latency: float = 0.0):
+    llm._client = StubClient(responder, latency)
+
+
+# Puts `count` new items in the given locations, a few per location
+def adder_responder(paths: list[str], count: int, per_location: int = 20) -> Responder:
+    def respond(prompt: str) -> list[dict]:
+        additions = []
+        for number in range(count):
+            if number % per_location == 0:
+                path = paths[(number // per_location) % len(paths)]
+                additions.append({"location": path, "items": []})
+            additions[-1]["items"].append({"name": f"New part {number}", "quantity": number % 4 + 1,
+                                           "description": ""})
+        return additions
+    return respond
+
+
+# Gives every item in the prompt one of the labels in the prompt, picked from its ID
+def labeler_responder() -> Responder:
+    def respond(prompt: str) -> list[dict]:
+        labels = LABEL_PATTERN.findall(prompt)
+        return [{"id": item_id, "labels": [labels[sum(map(ord, item_id)) % len(labels)]]}
+                for item_id in ITEM_ID_PATTERN.findall(prompt)]
+    return respond
+
+
+def install_recognizer(name: str = "benchmark", latency: float = 0.0):
+    def recognize(recognizer, audio) -> str:
+        time.sleep(latency)
+        return f"{len(audio.frame_data)} bytes of speech next"
+    register_recognizer(name, recognize)
+    return name
+
+
+# A WAV file of tones separated by short silences, for the recognizer to cut into segments
+def write_recording(filename: str, seconds: float, sample_rate: int = 16000):
+    frames = bytearray()
+    for index in range(int(seconds * sample_rate)):
+        speaking = (index // (sample_rate // 2)) % 3 != 2  # One second of tone, half a second of silence
+        value = int(8000 * math.sin(2 * math.pi * 440 * index / sample_rate)) if speaking else 0
+        frames += struct.pack("<h", value)
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(bytes(frames))
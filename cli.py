@@ -0,0 +1,76 @@
+# One entry point for all the tools, e.g. `python cli.py add memo.m4a` or `python cli.py label`
+# Only argparse is imported up front, each tool and its libraries are imported once it is chosen
+
+import sys
+import argparse
+import importlib
+
+# Subcommand -> module with a run(args) function
+COMMANDS = {
+    "add": "adder",
+    "label": "labeler",
+    "csv": "csv_tool",
+    "watch": "watcher"
+}
+
+
+def add_common_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--profile", action="store_true", help="profile the run with cProfile and save the result with the run report")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Tools for adding and labeling Homebox items with an LLM.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="add items to Homebox from voice recordings",
+                              description="Add items to Homebox from voice recordings.")
+    add.add_argument("files", nargs="*", help="audio files to process, asks for one if none are given")
+    add.add_argument("--resync", action="store_true", help="fetch everything from Homebox instead of the local snapshot")
+    add.add_argument("--no-transcript-cache", action="store_true", help="transcribe again even if the recording was seen before")
+    add.add_argument("--no-llm-cache", action="store_true", help="send transcripts to the LLM even if they were formatted before")
+    add_common_arguments(add)
+
+    label = commands.add_parser("label", help="let an LLM label your Homebox items",
+                                description="Let an LLM label your Homebox items.")
+    label.add_argument("--no-cache", action="store_true", help="ignore cached LLM answers and do not store new ones")
+    label.add_argument("--clear-cache", action="store_true", help="forget all cached LLM answers before labeling")
+    label.add_argument("--resync", action="store_true", help="fetch everything from Homebox instead of the local snapshot")
+    add_common_arguments(label)
+
+    csv = commands.add_parser("csv", help="move your Homebox inventory in and out of CSV files",
+                              description="Move your Homebox inventory in and out of CSV files.")
+    directions = csv.add_subparsers(dest="direction", required=True)
+    export_parser = directions.add_parser("export", help="write all items to a CSV file")
+    export_parser.add_argument("file", help="CSV file to write")
+    add_common_arguments(export_parser)
+    import_parser = directions.add_parser("import", help="add the items in a CSV file to Homebox")
+    import_parser.add_argument("file", help="CSV file to read")
+    import_parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of an earlier import of the file")
+    add_common_arguments(import_parser)
+
+    watch = commands.add_parser("watch", help="keep adding recordings dropped into the inbox folder",
+                                description="Keep adding recordings dropped into the inbox folder to Homebox.")
+    watch.add_argument("--inbox", help="folder to watch, instead of the one in config.ini")
+    watch.add_argument("--review", action="store_true", help="review and add the recordings held back for review")
+    add_common_arguments(watch)
+
+    return parser
+
+
+# Arguments of one tool, for running its script directly, e.g. `python adder.py memo.m4a`
+def parse_command(command: str, argv: list[str] = None) -> argparse.Namespace:
+    return build_parser().parse_args([command, *(sys.argv[1:] if argv is None else argv)])
+
+
+def main(argv: list[str] = None):
+    args = build_parser().parse_args(argv)
+
+    # Ask before importing anything heavy, so the prompt shows up right away
+    if args.command == "add" and not args.files:
+        args.files = [input("Which file should be processed? ")]
+
+    importlib.import_module(COMMANDS[args.command]).run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+from backend.general import end_safely
+from backend.api_access import get_homebox_auth_key
+from backend.csv_io import export_items, import_items
+from backend.tracing import traced_run
+from cli import parse_command
+
+import os
+import time
+import argparse
+from dotenv import load_dotenv
+
+
+def export_csv(filename: str):
+    load_dotenv()
+
+    auth = get_homebox_auth_key()
+
+    start = time.perf_counter()
+    count = export_items(filename, auth)
+    print(f"Exported {count} items to {filename} in {time.perf_counter() - start:.1f}s.")
+
+
+def import_csv(filename: str, restart: bool = False):
+    if not os.path.exists(filename):
+        print("Error: File does not exist.")
+        return
+
+    load_dotenv()
+
+    auth = get_homebox_auth_key()
+
+    start = time.perf_counter()
+    checkpoint = import_items(filename, auth, restart)
+    print(f"Added {checkpoint.added} items in {time.perf_counter() - start:.1f}s, {checkpoint.failed} failed.")
+    if checkpoint.failed:
+        print(f"Failed rows were written to {filename}.failed.csv, fix them and import that file.")
+
+
+def run(args: argparse.Namespace):
+    with traced_run(f"csv-{args.direction}", profile=args.profile):
+        if args.direction == "export":
+            export_csv(args.file)
+        else:
+            import_csv(args.file, args.restart)
+
+    end_safely(0)
+
+
+if __name__ == "__main__":
+    run(parse_command("csv"))
@@ -1,28 +1,97 @@
-from backend.general import config, end_safely
-from backend.api_access import get_homebox_auth_key, get_labels, get_all_items, update_item
-from backend.llm import get_parsed_list
-from backend.error_check import check_for_errors
+from backend.general import config, end_safely, override_config
+from backend.api_access import get_homebox_auth_key, get_labels, iter_items, get_item, update_item, project_item, HomeboxAuthError
+from backend.bulk import run_bulk
+from backend.llm import get_parsed_list, estimate_tokens
+from backend.error_check import check_for_errors, diff_records
+from backend.cache import ResultCache, make_key
+from backend.snapshot import SnapshotStore
+from backend.preclassify import PreClassifier
+from backend.tracing import span, traced_run
+from cli import parse_command
 
+import time
+import argparse
+from functools import cache
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
-from pydantic import BaseModel
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
+# Only these fields are needed to label an item, the full item is fetched again before updating
+LLM_FIELDS = ["id", "name", "description", "labels", "updatedAt"]
 
-class Item(BaseModel):
-    id: str
-    labels: Optional[list[str]]
+# Bump when the labeling prompt changes, so cached answers from the old prompt are not reused
+PROMPT_VERSION = 1
 
 
-def remove_items_with_labels(items: dict) -> dict:
-    new_items = {}
+# Data model for Gemini return, only built once needed since pydantic is slow to import
+@cache
+def response_schema() -> type:
+    from pydantic import BaseModel
+
+    class Item(BaseModel):
+        id: str
+        labels: Optional[list[str]]
+
+    return list[Item]
+
+
+def remove_items_with_labels(items: Iterable[dict]) -> Iterator[dict]:
+    for item in items:
+        if not item["labels"]:
+            yield item
+
+
+# Fingerprint of the label set, cached answers are only valid for the labels they were chosen from
+def labels_fingerprint(labels: dict) -> str:
+    return make_key(sorted((label["name"], label.get("description", "")) for label in labels.values()))
+
+
+def cache_key(item: dict, label_fingerprint: str) -> str:
+    return make_key(item["name"], item["description"], label_fingerprint, PROMPT_VERSION)
+
+
+# Pass on items without a cached answer, collecting the cached answers of the others in hits
+def skip_cached(items: Iterable[dict], cache: ResultCache, label_fingerprint: str,
+                hits: list[dict]) -> Iterator[dict]:
+    for item in items:
+        cached = cache.get(cache_key(item, label_fingerprint))
+        if cached is None:
+            yield item
+        else:
+            hits.append({"id": item["id"], "labels": cached})
+
+
+def item_line(item: dict) -> str:
+    return f"ID: <{item['id']}> Name: {item['name']}: {item['description']}"
+
+
+# Pass items through unchanged while keeping them by ID for later lookups
+def collect_items(stream: Iterable[dict], items: dict) -> Iterator[dict]:
+    for item in stream:
+        items[item["id"]] = item
+        yield item
+
+
+# Group items into chunks whose item lines stay within the token budget
+def chunk_items(items: Iterable[dict], token_budget: int) -> Iterator[list[dict]]:
+    chunk = []
+    used = 0
     for item in items:
-        if not items[item]["labels"]:
-            new_items[item] = items[item]
-    return new_items
+        tokens = estimate_tokens(item_line(item))
+        if chunk and used + tokens > token_budget:
+            yield chunk
+            chunk = []
+            used = 0
+        chunk.append(item)
+        used += tokens
+
+    if chunk:
+        yield chunk
 
 
-def process_with_llm(items: dict, labels: dict) -> list[dict]:
-    items_string = [f"ID: <{key}> Name: {item['name']}: {item['description']}" for key, item in items.items()]
+def build_prompt(chunk: list[dict], labels: dict) -> str:
+    items_string = [item_line(item) for item in chunk]
     labels_string = [f"<{labels[label]['name']}> with description {labels[label]['description']}" for label in labels]
     # AI prompt to structure labeling correctly
     prompt = f"""
@@ -42,57 +111,280 @@ def process_with_llm(items: dict, labels: dict) -> list[dict]:
                 END OF LIST
                 """
 
+    return prompt
+
+
+# Label one chunk of items, returning the parsed results and how long the LLM took
+def label_chunk(chunk: list[dict], labels: dict) -> (list[dict], float):
     llm_config = {
             "response_mime_type": "application/json",
-            "response_schema": list[Item]
+            "response_schema": response_schema()
         }
 
-    return get_parsed_list(prompt, llm_config)
+    start = time.perf_counter()
+    results = get_parsed_list(build_prompt(chunk, labels), llm_config)
+    return results, time.perf_counter() - start
+
+
+def report_throughput(count: int, elapsed: float, latencies: list[float]):
+    if not latencies:
+        return
+    rate = count / elapsed if elapsed else 0
+    print(f"Labeled {count} items in {elapsed:.1f}s ({rate:.1f} items/sec) over {len(latencies)} LLM requests")
+    print(f"Per chunk latency: average {sum(latencies) / len(latencies):.2f}s, "
+          f"fastest {min(latencies):.2f}s, slowest {max(latencies):.2f}s")
+
+
+# Send items to the LLM in token limited chunks, several chunks at a time
+# Items the LLM leaves out of its answer are sent again in a later chunk
+def process_with_llm(items: Iterable[dict], labels: dict) -> list[dict]:
+    token_budget = config.getint("LABELER", "chunk_token_budget", fallback=4000)
+    workers = config.getint("LABELER", "llm_workers", fallback=4)
+    max_requeue = config.getint("LABELER", "max_requeue", fallback=2)
+
+    order = []
+    results = {}
+    attempts = {}
+    requeue = []
+    latencies = []
+    given_up = 0
+    start = time.perf_counter()
+
+    def handle(future: Future, chunk: list[dict]):
+        nonlocal given_up
+        try:
+            chunk_results, latency = future.result()
+            latencies.append(latency)
+        except Exception as e:
+            print(f"LLM request for {len(chunk)} items failed: {e}")
+            chunk_results = []
+
+        expected = {item["id"]: item for item in chunk}
+        for labeled in chunk_results:
+            if labeled["id"].startswith("<"):
+                labeled["id"] = labeled["id"][1:-1]
+            if labeled["id"] in expected and labeled["id"] not in results:
+                results[labeled["id"]] = labeled
+
+        for item_id, item in expected.items():
+            if item_id not in results:
+                attempts[item_id] = attempts.get(item_id, 0) + 1
+                if attempts[item_id] <= max_requeue:
+                    requeue.append(item)
+                else:
+                    given_up += 1
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {}
 
+        def submit(chunk: list[dict]):
+            order.extend(item["id"] for item in chunk if item["id"] not in attempts)
+            pending[pool.submit(label_chunk, chunk, labels)] = chunk
 
-def update_labels(data: list[dict], items: dict, labels: dict, auth: str):
+        # Wait for chunks to finish until at most `limit` are still running
+        def drain(limit: int):
+            while len(pending) > limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future, pending.pop(future))
+
+        for chunk in chunk_items(items, token_budget):
+            submit(chunk)
+            drain(workers * 2)
+
+        while pending or requeue:
+            if requeue:
+                retry = requeue[:]
+                requeue.clear()
+                for chunk in chunk_items(retry, token_budget):
+                    submit(chunk)
+            drain(len(pending) - 1)
+
+    report_throughput(len(results), time.perf_counter() - start, latencies)
+    if given_up:
+        print(f"{given_up} items were never labeled by the LLM and will be left as they are.")
+
+    return [results[item_id] for item_id in order if item_id in results]
+
+
+def strip_brackets(label: str) -> str:
+    return label[1:-1] if label.startswith("<") else label
+
+
+# Items the LLM gave no labels, or labels that do not exist in Homebox
+def is_uncertain(labeled: dict, labels: dict) -> bool:
+    suggested = labeled.get("labels")
+    if not suggested:
+        return True
+    if not isinstance(suggested, list):
+        suggested = [suggested]
+    return any(strip_brackets(label) not in labels for label in suggested)
+
+
+# Labels of the items as they are in Homebox now, to compare the reviewed labels with
+def current_records(data: list[dict], items: dict) -> list[dict]:
+    return [{"id": labeled["id"], "name": items[labeled["id"]]["name"],
+             "labels": [label["name"] for label in items[labeled["id"]]["labels"]]} for labeled in data]
+
+
+@dataclass
+class UpdateSummary:
+    succeeded: int = 0
+    skipped: int = 0
+    failed: list[str] = field(default_factory=list)
+    elapsed: float = 0
+
+
+# IDs of the known labels among the reviewed ones
+def label_ids(labeled: dict, labels: dict) -> set[str]:
+    suggested = labeled["labels"] if isinstance(labeled["labels"], list) else [labeled["labels"]]
+    ids = set()
+    for label in suggested:
+        label = strip_brackets(label)
+        if label in labels:
+            ids.add(labels[label]["id"])
+        else:
+            print(f"Label {label} does not exist in Homebox, it will not be added to {labeled.get('name', labeled['id'])}.")
+    return ids
+
+
+# Add the reviewed labels to the items, several items at a time
+# Items that already have all their labels are skipped without a request
+def update_labels(data: list[dict], items: dict, labels: dict, auth: str) -> UpdateSummary:
+    summary = UpdateSummary()
+    labels_by_id = {label["id"]: label for label in labels.values()}
+
+    tasks = []
     for labeled in data:
-        if "labels" not in labeled:
+        if not labeled.get("labels"):
+            summary.skipped += 1
             continue
-        item = items[labeled["id"]]
+        wanted = label_ids(labeled, labels)
+        if labeled["id"] in items:
+            current = {label["id"] for label in items[labeled["id"]]["labels"]}
+            if wanted <= current:
+                summary.skipped += 1
+                continue
+        tasks.append((labeled["id"], wanted))
+
+    # The full item is fetched right before replacing it, so nothing else on it is lost
+    def add_labels(task: tuple) -> bool | None:
+        item_id, wanted = task
+        item = get_item(auth, item_id)
+        missing = wanted - {label["id"] for label in item["labels"]}
+        if not missing:
+            return None
+        item["labels"].extend(labels_by_id[label_id] for label_id in missing)
+        return update_item(auth, item_id, item)
+
+    with span("labeler update labels") as current:
+        current.items = len(tasks)
+        result = run_bulk(
+            tasks,
+            add_labels,
+            max_workers=config.getint("BULK", "max_workers", fallback=4),
+            requests_per_second=config.getfloat("BULK", "requests_per_second", fallback=0),
+            stop_on=(HomeboxAuthError,),
+            retries=config.getint("BULK", "task_retries", fallback=2)
+        )
+    if result.error:
+        print("Homebox rejected the login, remaining items were not updated.")
 
-        if not isinstance(labeled["labels"], list):
-            labeled["labels"] = [labeled["labels"]]
-        for label in labeled["labels"]:
-            if label.startswith("<"):
-                label = label[1:-1]
-            label_dict = labels[label]
-            if label_dict not in item["labels"]:
-                item["labels"].append(label_dict)
+    for (item_id, _), res in zip(tasks, result.results):
+        if res is True:
+            summary.succeeded += 1
+        elif res is None and not result.error:
+            summary.skipped += 1
+        else:
+            summary.failed.append(item_id)
+            name = items[item_id]["name"] if item_id in items else item_id
+            print(f"{name} could not have labels added, skipping.")
+    summary.elapsed = result.elapsed
 
-        if not update_item(auth, item["id"], item):
-            print(f"{item['name']} could not have labels added, skipping.")
+    return summary
 
 
-def label_items():
+def label_items(use_cache: bool = True, clear_cache: bool = False):
     load_dotenv()
 
-    auth = get_homebox_auth_key()
-    items = get_all_items(auth)
-    labels = get_labels(auth)
+    with span("labeler login"):
+        auth = get_homebox_auth_key()
+
+    store = SnapshotStore(auth)
+    store.refresh("labels", get_labels)
+    if store.enabled:
+        # Only items changed since the last run are fetched, a full fetch streams like iter_items
+        item_stream = (project_item(item, LLM_FIELDS) for item in store.stream_items())
+    else:
+        item_stream = iter_items(auth, LLM_FIELDS)
+    with span("labeler labels"):
+        labels = store.latest("labels")
+
+    # Every labeled item that streams past teaches the pre-classifier, before labeled items are dropped
+    preclassifier = None
+    if config.getboolean("PRECLASSIFIER", "enabled", fallback=True):
+        preclassifier = PreClassifier()
+        item_stream = preclassifier.observe(item_stream)
 
     if not config.getboolean("LABELER", "label_already_labeled"):
-        items = remove_items_with_labels(items)
-    print("Got items and labels from Homebox!")
+        item_stream = remove_items_with_labels(item_stream)
+    print("Got labels from Homebox, streaming items to the LLM!")
+
+    # Chunks are sent to the LLM as soon as they fill up, even while item pages are still being fetched
+    items = {}
+    item_stream = collect_items(item_stream, items)
+
+    cache = None
+    hits = []
+    if use_cache and config.getboolean("CACHE", "enabled", fallback=True):
+        cache = ResultCache("labeler")
+        if clear_cache:
+            cache.clear()
+        fingerprint = labels_fingerprint(labels)
+        item_stream = skip_cached(item_stream, cache, fingerprint, hits)
+
+    # Items named almost like an already labeled item get its labels without asking the LLM
+    preclassified = []
+    if preclassifier:
+        item_stream = preclassifier.filter(item_stream, labels, preclassified)
+
+    with span("labeler llm") as current:
+        data = process_with_llm(item_stream, labels)
+        current.items = len(items)
+
+    if cache:
+        cache.put_many({cache_key(items[labeled["id"]], fingerprint): labeled["labels"] or [] for labeled in data})
+        cache.close()
+        print(f"{len(hits)} items were labeled from cache.")
+    if preclassifier:
+        preclassifier.save()
+        preclassifier.report()
+    data = hits + preclassified + data
 
-    data = process_with_llm(items, labels)
     for item in data:
-        if item["id"].startswith("<"):
-            item["id"] = item["id"][1:-1]
         item["name"] = items[item["id"]]["name"]
     print("Processed with LLM!")
 
-    data = check_for_errors(data)
-    print("Checked for Errors!")
+    with span("labeler review") as current:
+        current.items = len(data)
+        original = current_records(data, items)
+        data = check_for_errors(data, only=lambda labeled: is_uncertain(labeled, labels))
+        diff = diff_records(original, data)
+    print(f"Checked for Errors! {len(diff.unchanged)} items already have these labels "
+          f"and {len(diff.deleted)} were removed, they will not be updated.")
+
+    summary = update_labels(diff.changed, items, labels, auth)
+    print(f"Labeled! {summary.succeeded} items updated, {summary.skipped} already had their labels "
+          f"and {len(summary.failed)} failed, in {summary.elapsed:.1f}s.")
+
+
+def run(args: argparse.Namespace):
+    if args.resync:
+        override_config("SNAPSHOT", "force_resync", True)
 
-    update_labels(data, items, labels, auth)
-    print("Labeled!")
+    with traced_run("labeler", profile=args.profile):
+        label_items(use_cache=not args.no_cache, clear_cache=args.clear_cache)
 
 
 if __name__ == "__main__":
-    label_items()
+    run(parse_command("label"))
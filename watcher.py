@@ -0,0 +1,222 @@
+from backend.general import config, project_root, translate_locations
+from backend.api_access import get_homebox_auth_key, get_location_tree, index_locations, get_all_items
+from backend.locations import LocationIndex
+from backend.snapshot import SnapshotStore
+from backend.voice_recognition import transcribe_sound_file
+from backend.error_check import write_to_file_with_header, load_until_valid, load_from_file_with_header, open_in_editor
+from backend.duplicates import NameIndex, INDEX_FIELDS, propose_merges, has_merges
+from backend.tracing import span, traced_run
+from adder import process_with_llm, commit_data, add_data_to_storage
+from cli import parse_command
+
+import os
+import time
+import queue
+import argparse
+import threading
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".aiff", ".aif", ".mp3", ".m4a", ".ogg", ".opus", ".aac", ".wma", ".webm"}
+
+
+# One recording on its way through the stages
+@dataclass
+class Job:
+    filename: str
+    text: str = ""
+    ready: list[dict] = field(default_factory=list)    # Entries that can be added without review
+    pending: list[dict] = field(default_factory=list)  # Entries held back for review
+    started: float = field(default_factory=time.perf_counter)
+
+
+# Long running adder, taking recordings dropped into the inbox folder through transcribe, structure and commit
+# Each stage has its own workers, and the login, locations and LLM client stay ready between recordings
+# Nothing ever waits for the editor, anything uncertain is written to the pending folder for `--review`
+class Watcher:
+    def __init__(self, inbox: str):
+        self.inbox = inbox
+        self.folders = {name: os.path.join(inbox, name) for name in ("processing", "done", "failed", "pending")}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+
+        self.poll_seconds = config.getfloat("WATCH", "poll_seconds", fallback=2)
+        self.refresh_seconds = config.getfloat("WATCH", "location_refresh_minutes", fallback=10) * 60
+        self.auto_commit_cutoff = config.getfloat("WATCH", "auto_commit_cutoff", fallback=0.95)
+        self.review_merges = config.getboolean("WATCH", "review_merges", fallback=True)
+        self.merge_duplicates = config.getboolean("ADDER", "merge_duplicates", fallback=True)
+
+        self.auth = get_homebox_auth_key()
+        self.store = SnapshotStore(self.auth)
+        self.lock = threading.Lock()
+        self.locations: LocationIndex | None = None
+        self.name_index: NameIndex | None = None
+        self.refreshed = 0.0
+        self.refresh()
+
+        self.queues = {stage: queue.Queue() for stage in ("transcribe", "structure", "commit")}
+        self.workers: list[tuple[str, threading.Thread]] = []
+        self.sizes: dict[str, int] = {}
+
+    # Fetch locations and existing items again, at most every location_refresh_minutes
+    def refresh(self, force: bool = False):
+        with self.lock:
+            if not force and time.time() - self.refreshed < self.refresh_seconds:
+                return
+            with span("watch refresh"):
+                self.store.refresh("locations", get_location_tree)
+                self.locations = index_locations(self.store.latest("locations"))
+                if self.merge_duplicates:
+                    items = self.store.items() if self.store.enabled else get_all_items(self.auth, INDEX_FIELDS)
+                    self.name_index = NameIndex(items.values())
+            self.refreshed = time.time()
+
+    # Audio files in the inbox whose size did not change since the last look, so they are fully written
+    def scan(self) -> list[str]:
+        ready = []
+        sizes = {}
+        for name in sorted(os.listdir(self.inbox)):
+            path = os.path.join(self.inbox, name)
+            if not os.path.isfile(path) or os.path.splitext(name)[1].lower() not in AUDIO_EXTENSIONS:
+                continue
+            sizes[path] = os.path.getsize(path)
+            if self.sizes.get(path) == sizes[path]:
+                ready.append(path)
+        self.sizes = {path: size for path, size in sizes.items() if path not in ready}
+        return ready
+
+    def move(self, filename: str, folder: str) -> str:
+        target = os.path.join(self.folders[folder], os.path.basename(filename))
+        os.replace(filename, target)
+        return target
+
+    def transcribe(self, job: Job):
+        job.text = transcribe_sound_file(job.filename)
+        print(f"{os.path.basename(job.filename)} interpreted as: {job.text}")
+
+    def structure(self, job: Job):
+        self.refresh()
+        locations = self.locations
+        data = process_with_llm(job.text, locations.paths)
+
+        uncertain = set()
+        cutoff = config.getfloat("ADDER", "location_match_cutoff", fallback=0.85)
+        for entry in data:
+            if entry["location"] in locations:
+                continue
+            suggestions = locations.suggest(entry["location"], n=1, cutoff=cutoff)
+            if suggestions:
+                entry["location"] = suggestions[0][0]
+            if not suggestions or suggestions[0][1] < self.auto_commit_cutoff:
+                uncertain.add(id(entry))
+
+        if self.name_index is not None:
+            propose_merges(data, locations, self.name_index)
+
+        for entry in data:
+            held = id(entry) in uncertain or (self.review_merges and has_merges(entry))
+            (job.pending if held else job.ready).append(entry)
+
+    def commit(self, job: Job):
+        if job.ready:
+            locations = self.locations
+            failed = add_data_to_storage(translate_locations(job.ready, locations), self.auth)
+            for loc_id, items in failed.items():
+                job.pending.append({"location": locations.path_of(loc_id) or loc_id, "items": items})
+            self.refreshed = 0  # Added items must be in the name index before the next recording is checked
+        if job.pending:
+            name = os.path.splitext(os.path.basename(job.filename))[0]
+            write_to_file_with_header(os.path.join(self.folders["pending"], f"{name}.txt"), job.pending)
+            print(f"{len(job.pending)} locations from {name} need review, run the watcher with --review.")
+
+    # Take jobs from one stage's queue and pass them on to the next, moving the file to failed on errors
+    def work(self, stage: str, handle, next_stage: str | None):
+        jobs = self.queues[stage]
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                with span(f"watch {stage}"):
+                    handle(job)
+            except Exception as e:
+                print(f"{os.path.basename(job.filename)} failed in {stage}: {e}")
+                self.move(job.filename, "failed")
+                continue
+            if next_stage:
+                self.queues[next_stage].put(job)
+            else:
+                self.move(job.filename, "done")
+                print(f"Finished {os.path.basename(job.filename)} in {time.perf_counter() - job.started:.1f}s.")
+
+    def start(self):
+        stages = [("transcribe", self.transcribe, "structure"), ("structure", self.structure, "commit"),
+                  ("commit", self.commit, None)]
+        for stage, handle, next_stage in stages:
+            for number in range(max(1, config.getint("WATCH", f"{stage}_workers", fallback=2))):
+                thread = threading.Thread(target=self.work, args=(stage, handle, next_stage),
+                                          name=f"watch-{stage}-{number}", daemon=True)
+                thread.start()
+                self.workers.append((stage, thread))
+
+    # Let every queued recording finish, one stage at a time
+    def stop(self):
+        for stage in self.queues:
+            threads = [thread for thread_stage, thread in self.workers if thread_stage == stage]
+            for _ in threads:
+                self.queues[stage].put(None)
+            for thread in threads:
+                thread.join()
+
+    def run(self):
+        self.start()
+        for name in sorted(os.listdir(self.folders["processing"])):  # Left over from a run that was stopped
+            self.queues["transcribe"].put(Job(os.path.join(self.folders["processing"], name)))
+        print(f"Watching {self.inbox} for recordings, press Ctrl+C to stop.")
+        try:
+            while True:
+                for filename in self.scan():
+                    self.queues["transcribe"].put(Job(self.move(filename, "processing")))
+                time.sleep(self.poll_seconds)
+        except KeyboardInterrupt:
+            print("Stopping, finishing the recordings already started...")
+        self.stop()
+
+
+# Go through the recordings held back for review, adding them once they are checked
+def review_pending(inbox: str):
+    folder = os.path.join(inbox, "pending")
+    files = sorted(name for name in os.listdir(folder)) if os.path.isdir(folder) else []
+    if not files:
+        print("Nothing to review.")
+        return
+
+    auth = get_homebox_auth_key()
+    locations = index_locations(get_location_tree(auth))
+    for name in files:
+        filename = os.path.join(folder, name)
+        open_in_editor(filename)
+        input(f"Check {name}, save it and press enter to add its items...")
+        data = load_until_valid(load_from_file_with_header, filename, "location", "items")
+        commit_data(data, locations, auth)
+        os.replace(filename, os.path.join(inbox, "done", name))
+
+
+def inbox_folder() -> str:
+    return os.path.join(project_root, "..", config.get("WATCH", "inbox", fallback="inbox"))
+
+
+def run(args: argparse.Namespace):
+    load_dotenv()
+    inbox = args.inbox or inbox_folder()
+    os.makedirs(inbox, exist_ok=True)
+
+    with traced_run("watcher", profile=args.profile):
+        if args.review:
+            review_pending(inbox)
+        else:
+            Watcher(inbox).run()
+
+
+if __name__ == "__main__":
+    run(parse_command("watch"))